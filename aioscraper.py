@@ -0,0 +1,176 @@
+import asyncio
+import json
+import threading
+import time
+
+import aiohttp
+
+from metrics import METRICS
+from ratelimit import TokenBucket
+from retry import FetchError, RetryPolicy
+
+
+class AsyncScraper:
+    """asyncio counterpart of Scraper: one event loop, `connections` sockets."""
+
+    def __init__(
+        self, session, connections=10, qps=5, retry=None, limiter=None, cache=None
+    ):
+        self.cookies = session.cookies.get_dict()
+        self.headers = dict(session.headers)
+        self.connections = connections
+        self.limiter = limiter or TokenBucket(qps)
+        self.retry = retry or RetryPolicy()
+        self.cache = cache
+
+    def client(self):
+        # Cookies go with each request, which may be on behalf of any user;
+        # the dummy jar keeps responses from mixing them up.
+        connector = aiohttp.TCPConnector(limit=self.connections)
+        jar = aiohttp.DummyCookieJar()
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(count_connection)
+        return aiohttp.ClientSession(
+            headers=self.headers,
+            connector=connector,
+            cookie_jar=jar,
+            trace_configs=[trace],
+        )
+
+    async def get(self, client, url, cookies=None):
+        """Returns the json at url, retrying per self.retry (whose failed
+        decides, as it does for RetryPolicy.call, which can't await).
+        """
+        cookies = cookies or self.cookies
+        # A quick local lookup; not worth a thread.
+        cached = self.cache.request(url, cookies=cookies) if self.cache else None
+        if cached and cached.fresh:
+            return json.loads(cached.hit())
+        validators = cached.validators() if cached else {}
+
+        for attempt in range(self.retry.attempts):
+            try:
+                ok, status, headers, body = await self.send(
+                    client, url, cookies, validators
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                await asyncio.sleep(self.retry.failed(attempt, url, error=e))
+                continue
+            try:
+                if status == 304 and cached and cached.cached:
+                    return json.loads(cached.revalidated())
+                if ok:
+                    if cached and status == 200:
+                        cached.save(body, headers)
+                    return json.loads(body)
+            except ValueError as e:
+                raise FetchError(url, "invalid json") from e
+            await asyncio.sleep(self.retry.failed(attempt, url, status, headers))
+
+    async def send(self, client, url, cookies, validators):
+        """One request, once the limiter allows: (ok, status, headers, body)."""
+        await self.limiter.wait_async()
+        start = time.monotonic()
+        try:
+            get = client.get(url, cookies=cookies, headers=validators)
+            async with get as response:
+                status, headers = response.status, response.headers
+                self.limiter.record(status, time.monotonic() - start)
+                body = await response.read()
+                # Bodies are decompressed as they're read; Content-Length
+                # is what came over the wire. Chunked responses don't
+                # have one, and count their decompressed size instead.
+                wire = int(headers.get("Content-Length", len(body)))
+                elapsed = time.monotonic() - start
+                METRICS.observe(url, elapsed, status, len(body), wire)
+                return response.ok, status, headers, body
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.limiter.record(None, None)
+            METRICS.observe(url, time.monotonic() - start, None, 0)
+            raise
+
+    async def produce(self, items, to_url, results, to_session=None):
+        """Fetches every item, putting (item, response) onto the bounded
+        results queue, which holds back new requests while it's full.
+        """
+        todo = iter(items)
+        cookies = lambda item: (
+            to_session(item).cookies.get_dict() if to_session else None
+        )
+
+        async def work(client):
+            for item in todo:
+                try:
+                    response = await self.get(client, to_url(item), cookies(item))
+                except FetchError as e:
+                    response = e
+                await results.put((item, response))
+
+        async with self.client() as client:
+            workers = [
+                asyncio.ensure_future(work(client)) for _ in range(self.connections)
+            ]
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                for w in workers:
+                    w.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+
+    async def run(self, items, to_url, results, to_session=None):
+        """produce, then (DONE, None) on results; or (DONE, exception) if
+        something went wrong.
+        """
+        try:
+            await self.produce(items, to_url, results, to_session)
+            await results.put((DONE, None))
+        except Exception as e:
+            await results.put((DONE, e))
+        # Keep the loop alive until the consumer has taken everything.
+        await results.join()
+
+    def stream(self, items, to_url, maxsize, to_session=None):
+        """Same contract as Scraper.stream. The event loop runs on a background
+        thread; the caller drains the queue from its own thread.
+        """
+        loop = asyncio.new_event_loop()
+        results = asyncio.Queue(maxsize)
+        producer = loop.create_task(self.run(items, to_url, results, to_session))
+
+        def run_loop():
+            try:
+                loop.run_until_complete(producer)
+            except asyncio.CancelledError:
+                pass
+
+        thread = threading.Thread(target=run_loop, daemon=True)
+        thread.start()
+        yield from drain(loop, results, producer, thread)
+
+
+DONE = object()  # what run puts on the queue when it's finished
+
+
+def drain(loop, results, producer, thread):
+    """Yields what the producer puts on results, from another thread than
+    loop's, until it's DONE (raising any exception it hit); then stops it.
+    """
+    try:
+        while True:
+            get = asyncio.run_coroutine_threadsafe(results.get(), loop)
+            item, result = get.result()
+            loop.call_soon_threadsafe(results.task_done)
+            if item is not DONE:
+                yield item, result
+            elif result is not None:
+                raise result
+            else:
+                break
+    finally:
+        loop.call_soon_threadsafe(producer.cancel)
+        thread.join()
+        loop.close()
+
+
+async def count_connection(session, context, params):
+    METRICS.count("connections_opened")
@@ -1,25 +1,32 @@
 import json
-import requests
-import time
+from concurrent.futures import ThreadPoolExecutor
 import yaml
 from tqdm import tqdm
 
-from utils import format_date, chunk_dates
+from metrics import METRICS
+from ratelimit import AdaptiveRate, TokenBucket
+from retry import FetchError, RetryPolicy
+import scheduler
+import transport
+from utils import format_date, chunk_dates, interleave, plan_chunks
 
 
-def get_session(cookie_file):
+def get_session(cookie_file, connections=10):
+    """connections: the most threads that will share the session."""
     with open(cookie_file) as f:
         cookie = json.load(f)
-
-    session = requests.Session()
-    for k, v in cookie.items():
-        session.cookies.set(k, v)
-    return session
+    return transport.session(cookie, connections)
 
 
 def get_config(config_file):
     with open(config_file) as f:
-        return yaml.safe_load(f)
+        config = yaml.safe_load(f)
+    order = config["general"].get("order", "newest")
+    if order not in scheduler.ORDERS:
+        raise ValueError(
+            "general.order must be one of %s, not %r" % (scheduler.ORDERS, order)
+        )
+    return config
 
 
 def get_user_id(session, config):
@@ -42,14 +49,35 @@ def get_user_id(session, config):
     return user_id
 
 
+def get_limiter(config):
+    if not config.get("adaptive", False):
+        return TokenBucket(config["qps"])
+    return AdaptiveRate(
+        config["qps"],
+        min_rate=config.get("qps-min", 1),
+        max_rate=config.get("qps-max", 50),
+    )
+
+
 class Api:
-    def __init__(self, config_file, cookie_file):
+    def __init__(
+        self, config_file, cookie_file, limiter=None, user_id=None, cache=None
+    ):
+        """limiter: share another Api's limiter, so that requests on behalf of
+        several users all count against one rate.
+        user_id: the cookie's user id, if known; saves asking the server.
+        cache: an HttpCache for responses (see httpcache), if any.
+        """
         config = get_config(config_file)
-        self.session = get_session(cookie_file)
+        self.config = config
+        # One pool of kept-alive connections per user, for the whole run.
+        self.session = get_session(cookie_file, self.connections)
 
-        self.user_id = get_user_id(self.session, config["user"])
+        self.user_id = user_id or get_user_id(self.session, config["user"])
         config["info"]["url"] = config["info"]["url"].format(userId=self.user_id)
-        self.config = config
+        # One limiter for every request this run makes.
+        self.limiter = limiter or get_limiter(config["general"])
+        self.cache = cache
 
     @property
     def threads(self):
@@ -59,6 +87,36 @@ class Api:
     def qps(self):
         return self.config["general"]["qps"]
 
+    @property
+    def retry(self):
+        config = self.config["general"]
+        return RetryPolicy(
+            attempts=config.get("retries", 5),
+            backoff=config.get("backoff", 1.0),
+            backoff_max=config.get("backoff-max", 60.0),
+        )
+
+    @property
+    def queue_size(self):
+        return self.config["general"].get("queue-size", 100)
+
+    @property
+    def batch_size(self):
+        return self.config["general"].get("batch-size", 50)
+
+    @property
+    def engine(self):
+        return self.config["general"].get("engine", "threads")
+
+    @property
+    def connections(self):
+        return self.config["general"].get("connections", self.threads)
+
+    @property
+    def order(self):
+        """Which dates to fetch first: 'newest' or 'oldest' (see scheduler)."""
+        return self.config["general"].get("order", "newest")
+
     def get_puzzle_url(self, date, puzzle_type):
         config = self.config["puzzle"]
         args = {"type": puzzle_type, "date-str": format_date(date)}
@@ -76,38 +134,73 @@ class Api:
             [{'date': datetime, 'puzzle_id': str}, ...]
         puzzle_type is one of {'daily', 'mini'}
         """
-        config = self.config["info"]
+        return get_puzzle_infos([(self, dates, puzzle_type)], self.threads)[0]
 
-        def get_args(chunk):
-            d1, d2 = chunk
-            return {
-                "publish_type": puzzle_type,
-                "sort_order": "asc",
-                "sort_by": "print_date",
-                "date_start": format_date(d1),
-                "date_end": format_date(d2),
-            }
-
-        results = []
-        chunks = chunk_dates(dates, size=config["max-chunk-size"])
-        no_progress = len(chunks) == 0
-        progress_bar = tqdm(chunks, disable=no_progress, desc="getting info")
-        for chunk in progress_bar:
-            success, attempts = 0, False
-            while not success and attempts < 3:
-                attempts += 1
-                args = get_args(chunk)
-                status = "%s - %s" % (args["date_start"], args["date_end"])
-                progress_bar.set_postfix_str(status)
-                r = self.session.get(config["url"], params=args, headers=config["headers"])
-                if r.ok:
-                    j = r.json()
-                    if j.get("status") == "OK":
-                        results.extend(j.get("results", []))
-                    success = True
-                else:
-                    print("Error: %s %s %s" % (r.status_code, r.text, r.url))
-                    # Sleep for a second in case there's an intermittent issue.
-                    time.sleep(1)
-
-        return results
+    def get_info(self, chunk, puzzle_type):
+        """Puzzle info for the dates from chunk[0] to chunk[1]; [] if the
+        request failed.
+        """
+        config = self.config["info"]
+        d1, d2 = chunk
+        args = {
+            "publish_type": puzzle_type,
+            "sort_order": "asc",
+            "sort_by": "print_date",
+            "date_start": format_date(d1),
+            "date_end": format_date(d2),
+        }
+        url, headers = config["url"], config["headers"]
+        send = lambda validators: self.limiter.send(
+            lambda: METRICS.get(
+                self.session, url, params=args, headers=headers | validators
+            )
+        )
+        if self.cache:
+            get = lambda: self.cache.get(self.session, url, send, args)
+        else:
+            get = lambda: send({})
+        try:
+            j = self.retry.call(get, url).json()
+        except (FetchError, ValueError) as e:
+            status = "%s - %s" % (args["date_start"], args["date_end"])
+            print("Error: %s (%s)" % (e, status))
+            return []
+        return j.get("results", []) if j.get("status") == "OK" else []
+
+
+@METRICS.timed("api.get_puzzle_info")
+def get_puzzle_infos(lookups, threads):
+    """get_puzzle_info for several lookups, [(Api, dates, puzzle_type)], at
+    once: returns a list of results for each. Their chunks are taken in turn
+    (so no user waits on another's) by one pool of threads.
+    """
+    per_lookup = []
+    saved = 0
+    for i, (nyt, dates, puzzle_type) in enumerate(lookups):
+        size = nyt.config["info"]["max-chunk-size"]
+        chunks = plan_chunks(dates, size)
+        saved += len(chunk_dates(dates, size)) - len(chunks)
+        per_lookup.append([(i, chunk) for chunk in chunks])
+    chunks = interleave(*per_lookup)
+
+    def get_chunk(job):
+        i, chunk = job
+        nyt, _, puzzle_type = lookups[i]
+        return nyt.get_info(chunk, puzzle_type)
+
+    # Chunks may span dates we already have; drop those here.
+    wanted = [{format_date(d) for d in dates} for (_, dates, _) in lookups]
+    results = [[] for _ in lookups]
+    with ThreadPoolExecutor(max_workers=threads) as e:
+        responses = tqdm(
+            e.map(get_chunk, chunks),
+            total=len(chunks),
+            disable=not chunks,
+            desc="getting info",
+        )
+        for (i, _), r in zip(chunks, responses):
+            results[i].extend(p for p in r if p["print_date"] in wanted[i])
+
+    if chunks:
+        print("%d info requests (%d saved by coalescing gaps)" % (len(chunks), saved))
+    return results
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import glob
+import json
+import os
+import sys
+import zlib
+
+from datadir import DataDir
+from db import DB, Data, Puzzle, Storage
+from migrate import user_ids
+from packdir import PackDir
+from sqlitestore import SqliteStore, connect
+from statsfile import normalize, to_record
+from utils import chunker, format_date, parse_date_string
+from watermark import Watermarks
+
+"""
+Checks every puzzle and full_stats document in a data dir: that it decodes,
+has the fields the rest of xwdata relies on (and isn't an error response),
+and is dated as it's filed. Also checks that each stats csv row says what
+its full_stats document does. The documents are spread over a pool of
+processes, a few hundred at a time.
+
+    python3 audit.py DATA_DIR
+    python3 audit.py DATA_DIR --repair
+
+--repair sets bad documents aside (see DataDir.remove) so that main.py
+fetches them again (forgetting them in the watermarks and the response
+cache), and rewrites disagreeing csv rows from full_stats.
+"""
+
+CHUNK = 200  # documents per task
+
+# Keys that error responses have and documents don't.
+ERROR_KEYS = {"error", "errors", "message", "status"}
+
+
+def problem(doc, required):
+    """What's wrong with doc, a json object that should have required keys."""
+    if not isinstance(doc, dict):
+        return "not a json object"
+    lacking = [k for k in required if k not in doc]
+    if not lacking:
+        return None
+    if ERROR_KEYS & doc.keys():
+        return "error response %s" % json.dumps(doc)[:80]
+    return "missing %s" % ", ".join(lacking)
+
+
+def puzzle_problem(doc):
+    found = problem(doc, ["publicationDate", "body"])
+    if found:
+        return found
+    if not isinstance(doc["body"], list) or not doc["body"]:
+        return "empty body"
+    body = doc["body"][0]
+    found = problem(body, ["cells", "clues", "dimensions"])
+    if found:
+        return "body: %s" % found
+    size = body["dimensions"]
+    cells = size.get("width", 0) * size.get("height", 0)
+    if len(body["cells"]) != cells:
+        return "%d cells in a %sx%s grid" % (
+            len(body["cells"]),
+            size.get("width"),
+            size.get("height"),
+        )
+    return None
+
+
+# What statsfile.to_record needs of a solved puzzle's full stats.
+SOLVED = {"calcs": ["secondsSpentSolving"], "firsts": ["opened", "solved"]}
+
+
+def stats_problem(doc):
+    found = problem(doc, ["print_date", "puzzle_id", "calcs", "firsts"])
+    if found or not doc["calcs"].get("solved"):
+        return found
+    for name, required in SOLVED.items():
+        found = problem(doc[name], required)
+        if found:
+            return "%s: %s" % (name, found)
+    return None
+
+
+CHECKS = {
+    Data.PUZZLE: (puzzle_problem, "publicationDate"),
+    Data.FULL_STATS: (stats_problem, "print_date"),
+}
+
+
+def source(database, store, dates):
+    """What a worker process needs to open store, to load dates: see open_store."""
+    if database.storage == Storage.SQLITE:
+        return (os.path.join(database.dir, DB.SQLITE_FILE),) + store.key
+    return store.directory, store.basename, {d: store.index[d] for d in dates}
+
+
+def open_store(storage, where):
+    if storage == Storage.SQLITE:
+        filename, user, ptype, kind = where
+        return SqliteStore(connect(filename), user, ptype, kind)
+    directory, basename, index = where
+    store = (PackDir if storage == Storage.PACK else DataDir)(directory, basename)
+    store.index = index
+    return store
+
+
+def check(storage, where, kind, dates):
+    """Checks the documents at dates in one store. Returns [(date, problem)]
+    for the bad ones, and, for full_stats, {YYYY-MM-DD: the csv row it makes}
+    for the rest.
+    """
+    store = open_store(storage, where)
+    problem_of, date_field = CHECKS[kind]
+    problems, rows = [], {}
+    for date in dates:
+        try:
+            doc = store.load(date)
+        except (OSError, ValueError, zlib.error) as e:
+            problems.append((date, "unreadable: %s" % e))
+            continue
+        found = problem_of(doc)
+        if not found:
+            try:
+                dated = parse_date_string(doc[date_field])
+            except (TypeError, ValueError):
+                dated = None
+            if dated != date:
+                found = "%s is %r" % (date_field, doc[date_field])
+        if found:
+            problems.append((date, found))
+        elif kind == Data.FULL_STATS:
+            rows[format_date(date)] = normalize(to_record(doc))
+    return problems, rows
+
+
+def stats_rows(stats):
+    """{YYYY-MM-DD: csv row} for a stats StatsFile or SqliteStore."""
+    if isinstance(stats, SqliteStore):
+        rows = (json.loads(body) for (body,) in stats.select("body"))
+    else:
+        rows = stats.columns.rows()
+    return {r["date"]: normalize(r) for r in rows}
+
+
+def disagreements(row, expected):
+    return ", ".join(
+        "%s %r, not %r" % (k, row[k], expected[k]) for k in row if row[k] != expected[k]
+    )
+
+
+def databases(directory, storage, puzzle_types):
+    """(label, DB) for the shared puzzles, then for each user's stats."""
+    yield "puzzles", DB(directory, puzzle_types, [], True, "", storage)
+    if storage == Storage.SQLITE:
+        conn = connect(os.path.join(directory, DB.SQLITE_FILE))
+        rows = conn.execute("SELECT DISTINCT user FROM records WHERE user != ''")
+        users = sorted(u for (u,) in rows)
+    else:
+        users = user_ids(directory)
+    for uid in users:
+        yield uid, DB(directory, puzzle_types, Data.stat_kinds(), False, uid, storage)
+
+
+def audit(args):
+    """Prints every problem found (fixing them with args.repair), and
+    returns how many there were.
+    """
+    stores = open_stores(args)
+    bad, expected, n = check_all(args, stores)
+    mismatched = mismatches(stores, expected)
+    for (label, kind, ptype), problems in bad.items():
+        for date, found in sorted(problems):
+            print("%s %s %s %s: %s" % (label, kind, ptype, format_date(date), found))
+
+    total = sum(map(len, bad.values())) + sum(map(len, mismatched.values()))
+    print("%d documents checked, %d problems" % (n, total))
+    if args.repair and total:
+        repair(args, stores, bad, mismatched)
+    return total
+
+
+def open_stores(args):
+    """[(label, DB, kind, puzzle_type)] for every store of documents."""
+    stores = []
+    for label, database in databases(args.data_dir, args.storage, args.types):
+        database.read(datetime.min)
+        for kind in [Data.PUZZLE, Data.FULL_STATS]:
+            for ptype in database.dbs.get(kind, {}):
+                stores.append((label, database, kind, ptype))
+    return stores
+
+
+def check_all(args, stores):
+    """Checks every document in stores on a pool of processes. Returns the
+    problems, {(label, kind, ptype): [(date, problem)]}, the csv rows the
+    good full_stats make, {(label, ptype): {YYYY-MM-DD: csv row}}, and how
+    many documents were checked.
+    """
+    bad, expected = {}, {}
+    n = 0
+    with ProcessPoolExecutor(args.jobs) as pool:
+        futures = []
+        for label, database, kind, ptype in stores:
+            store = database.dbs[kind][ptype]
+            for dates in chunker(store.dates(), CHUNK):
+                where = source(database, store, dates)
+                task = pool.submit(check, args.storage, where, kind, dates)
+                futures.append(((label, kind, ptype), task))
+                n += len(dates)
+        for key, task in futures:
+            problems, rows = task.result()
+            bad.setdefault(key, []).extend(problems)
+            expected.setdefault((key[0], key[2]), {}).update(rows)
+    return bad, expected, n
+
+
+def mismatches(stores, expected):
+    """Prints the csv rows that disagree with expected, and returns their
+    dates, {(label, ptype): [YYYY-MM-DD]}.
+    """
+    mismatched = {}
+    for label, database, kind, ptype in stores:
+        if kind != Data.FULL_STATS or Data.STATS not in database.dbs:
+            continue
+        rows = stats_rows(database.dbs[Data.STATS][ptype])
+        for day, row in sorted(expected.get((label, ptype), {}).items()):
+            if day in rows and rows[day] != row:
+                differences = disagreements(rows[day], row)
+                print("%s stats %s %s: csv has %s" % (label, ptype, day, differences))
+                mismatched.setdefault((label, ptype), []).append(day)
+    return mismatched
+
+
+def repair(args, stores, bad, mismatched):
+    puzzles = {}  # {ptype: dates}
+    stats = {}  # {user id: puzzle ids}
+    n = 0
+    for label, database, kind, ptype in stores:
+        if bad.get((label, kind, ptype)):
+            dates = [date for (date, _) in bad[label, kind, ptype]]
+            database.dbs[kind][ptype].remove(dates)
+            n += len(dates)
+            # Otherwise the watermarks would vouch for them as still there.
+            key = "%s %s %s" % (args.storage, kind, ptype)
+            if kind == Data.PUZZLE:
+                puzzles[ptype] = dates
+            else:
+                database.watermarks.forget(key, dates)
+                database.watermarks.save()
+                ids = stats.setdefault(label, [])
+                if Data.STATS in database.dbs:
+                    rows = stats_rows(database.dbs[Data.STATS][ptype])
+                    days = [format_date(d) for d in dates]
+                    ids += [rows[d]["puzzle_id"] for d in days if d in rows]
+
+        if kind == Data.FULL_STATS and (label, ptype) in mismatched:
+            docs = database.dbs[kind][ptype]
+            stats_file = database.dbs[Data.STATS][ptype]
+            dates = map(parse_date_string, mismatched[label, ptype])
+            stats_file.write([docs.load(d) for d in dates])
+            if hasattr(stats_file, "rollups"):  # a StatsFile
+                stats_file.compact()
+                stats_file.rollups.rebuild(stats_file.columns)
+                stats_file.rollups.save()
+
+    if puzzles or stats:
+        forget(args, puzzles, stats)
+    m = sum(map(len, mismatched.values()))
+    print("Set aside %d documents to fetch again; rewrote %d csv rows" % (n, m))
+
+
+def forget(args, puzzles, stats):
+    """Forgets {puzzle_type: dates} in every user's watermarks (whoever
+    fetched the puzzles), and drops the cached responses behind them and
+    behind {user id: puzzle ids} of bad full_stats, so that they aren't
+    served again: puzzles are cached forever, and stats revalidated ones
+    may just come back as not modified. Each user's info responses are
+    dropped too. Stats are found by the puzzle id in the csv, so a date
+    with no csv row keeps its cached response.
+    """
+    for filename in glob.glob(os.path.join(args.data_dir, "*", "watermarks.json")):
+        watermarks = Watermarks(filename)
+        for ptype, dates in puzzles.items():
+            watermarks.forget("%s %s %s" % (args.storage, Data.PUZZLE, ptype), dates)
+        watermarks.save()
+
+    cache = os.path.join(args.data_dir, "http-cache")
+    if not os.path.isdir(cache):
+        return
+    import api
+    import httpcache
+
+    config = api.get_config(args.config)
+    url = config["puzzle"]["url"]
+    urls = [
+        url.format(**{"type": ptype, "date-str": format_date(d)})
+        for ptype, dates in puzzles.items()
+        for d in dates
+    ]
+    for uid, ids in stats.items():
+        urls.append(config["info"]["url"].format(userId=uid))
+        urls += [config["stats"]["url"].format(puzzle_id=i) for i in ids if i]
+    httpcache.from_config(cache, config).forget(urls)
+
+
+A = ArgumentParser(
+    description="Checks the puzzles and stats stored in DATA_DIR for corrupt, "
+    "incomplete or misfiled documents, optionally fixing what it finds.",
+    formatter_class=ArgumentDefaultsHelpFormatter,
+)
+A.add_argument("data_dir")
+A.add_argument("--storage", choices=Storage.types(), default=Storage.FILES)
+A.add_argument("--types", nargs="+", choices=Puzzle.types(), default=Puzzle.types())
+A.add_argument(
+    "-j", "--jobs", type=int, default=os.cpu_count(), help="Processes to use"
+)
+A.add_argument(
+    "--repair",
+    action="store_true",
+    help="Set bad documents aside to be fetched again by main.py, and rewrite "
+    "csv rows from full_stats",
+)
+A.add_argument(
+    "--config",
+    default="api-config.yaml",
+    help="For the response cache's urls, with --repair",
+)
+
+
+if __name__ == "__main__":
+    sys.exit(1 if audit(A.parse_args()) else 0)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from datetime import date, datetime, timedelta
+
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+from mockserver import MockServer, make_game, make_info, make_puzzle
+
+"""
+End-to-end benchmarks against a local mockserver.MockServer: no network
+and no real cookie needed. Each scenario runs main.py in a child process
+and reports requests/s, server-side p50/p99 latency, the child's peak RSS
+and the time it spent in DB.read/DB.store ("disk").
+
+    python3 bench.py --days 120 --years 2 --latency 0.02
+"""
+
+HERE = pathlib.Path(__file__).parent.resolve()
+USER = "bench"
+
+
+def child(mode, argv):
+    """Runs in the child process: main.py (mode 'sync') or a full read of
+    every stored document (mode 'scan'), timing DB.read and DB.store.
+    """
+    import db
+
+    disk = [0.0]
+
+    def timed(f):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                disk[0] += time.perf_counter() - start
+
+        return wrapper
+
+    db.DB.read = timed(db.DB.read)
+    db.DB.store = timed(db.DB.store)
+
+    if mode == "sync":
+        import main
+
+        sys.argv = ["main.py"] + argv
+        main.main()
+    else:
+        directory, storage = argv
+        kinds = db.Data.stat_kinds()
+        database = db.DB(directory, db.Puzzle.types(), kinds, True, USER, storage)
+        database.read(datetime.min)
+        start = time.perf_counter()
+        for kind in database.dbs:
+            for store in database.dbs[kind].values():
+                if hasattr(store, "documents"):
+                    for _ in store.documents():
+                        pass
+        disk[0] += time.perf_counter() - start
+
+    print("BENCH " + json.dumps({"disk": disk[0]}))
+
+
+def run_child(mode, argv):
+    """Returns (wall seconds, peak RSS in MB, disk seconds) for a child run."""
+    cmd = [sys.executable, __file__, "--child", mode] + argv
+    start = time.perf_counter()
+    p = subprocess.Popen(
+        cmd, cwd=HERE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    out = p.stdout.read().decode()
+    _, status, rusage = os.wait4(p.pid, 0)
+    wall = time.perf_counter() - start
+    if status != 0:
+        raise RuntimeError("%s failed:\n%s" % (" ".join(cmd), out))
+    line = [x for x in out.splitlines() if x.startswith("BENCH ")][-1]
+    disk = json.loads(line[len("BENCH ") :])["disk"]
+    return wall, rusage.ru_maxrss / 1024, disk  # ru_maxrss is in KB on Linux
+
+
+def build_archive(directory, begin, end, storage):
+    """Stores begin..end worth of puzzles and stats directly, without the
+    server, as a stand-in for a long history.
+    """
+    from db import DB, Data, Puzzle
+
+    database = DB(directory, Puzzle.types(), Data.stat_kinds(), True, USER, storage)
+    days = [begin + timedelta(i) for i in range((end - begin).days + 1)]
+    for ptype in Puzzle.types():
+        for i in range(0, len(days), 100):
+            dates = days[i : i + 100]
+            database.store([make_puzzle(ptype, d) for d in dates], Data.PUZZLE, ptype)
+            info = make_info(USER, ptype, dates[0], dates[-1], 1.0)["results"]
+            stats = [make_game(USER, pi["puzzle_id"]) | pi for pi in info]
+            database.store(stats, Data.stat_kinds(), ptype)
+    database.compact()
+
+
+def write_config(server, directory, args):
+    """An api config pointing at server, with the client settings in args."""
+    filename = os.path.join(directory, "config.yaml")
+    server.write_config(HERE / "api-config.yaml", filename)
+    with open(filename) as f:
+        config = yaml.safe_load(f)
+    config["general"].update(qps=args.qps, threads=args.threads, engine=args.engine)
+    with open(filename, "w") as f:
+        yaml.safe_dump(config, f)
+    return filename
+
+
+def scenario(server, name, mode, argv):
+    server.stats.reset()
+    wall, rss, disk = run_child(mode, argv)
+    n = server.stats.requests()
+    return {
+        "scenario": name,
+        "requests": n,
+        "wall_s": wall,
+        "requests_per_s": n / wall,
+        "p50_ms": server.stats.percentile(50) * 1000,
+        "p99_ms": server.stats.percentile(99) * 1000,
+        "peak_rss_mb": rss,
+        "disk_s": disk,
+    }
+
+
+def report(results):
+    columns = [
+        ("scenario", "%-16s"),
+        ("requests", "%9d"),
+        ("wall_s", "%8.2f"),
+        ("requests_per_s", "%8.1f"),
+        ("p50_ms", "%8.1f"),
+        ("p99_ms", "%8.1f"),
+        ("peak_rss_mb", "%8.1f"),
+        ("disk_s", "%8.2f"),
+    ]
+    header = "%-16s%9s%8s%8s%8s%8s%8s%8s" % (
+        "scenario",
+        "requests",
+        "wall s",
+        "req/s",
+        "p50 ms",
+        "p99 ms",
+        "RSS MB",
+        "disk s",
+    )
+    print(header)
+    for r in results:
+        print("".join(fmt % r[k] for k, fmt in columns))
+
+
+def main(args):
+    server = MockServer(
+        latency=args.latency,
+        jitter=args.latency / 2,
+        error_rate=args.error_rate,
+        qps_limit=args.qps_limit,
+    ).start()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        config = write_config(server, tmp, args)
+        cookie = os.path.join(tmp, "cookie.json")
+        with open(cookie, "w") as f:
+            json.dump({"NYT-S": USER}, f)
+
+        today = date.today()
+        begin = today - timedelta(args.days)
+        data = os.path.join(tmp, "data")
+        options = ["-c", config, "-n", cookie, "--storage", args.storage]
+        sync = [data, "-b", begin.isoformat()] + options
+        results.append(scenario(server, "cold backfill", "sync", sync))
+        results.append(scenario(server, "no-op sync", "sync", sync))
+
+        if args.years:
+            archive = os.path.join(tmp, "archive")
+            first = today - timedelta(365 * args.years)
+            build_archive(archive, first, today - timedelta(1), args.storage)
+            sync = [archive, "-b", first.isoformat()] + options
+            name = "%dy archive sync" % args.years
+            results.append(scenario(server, name, "sync", sync))
+            results.append(
+                scenario(
+                    server,
+                    "%dy archive scan" % args.years,
+                    "scan",
+                    [archive, args.storage],
+                )
+            )
+
+    server.shutdown()
+    report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+A = ArgumentParser(
+    description="Benchmarks main.py end to end against a local mock server.",
+    formatter_class=ArgumentDefaultsHelpFormatter,
+)
+A.add_argument("--days", type=int, default=90, help="Days of history to backfill")
+A.add_argument("--years", type=int, default=2, help="Years of archive (0: skip)")
+A.add_argument("--latency", type=float, default=0.02, help="Server seconds/request")
+A.add_argument("--error-rate", type=float, default=0.0, help="Fraction of 503s")
+A.add_argument("--qps-limit", type=int, default=None, help="Server 429s beyond this")
+A.add_argument("--qps", type=int, default=50, help="general.qps for the client")
+A.add_argument("--threads", type=int, default=10, help="general.threads")
+A.add_argument("--engine", choices=["threads", "async"], default="threads")
+A.add_argument("--storage", choices=["files", "pack", "sqlite"], default="files")
+A.add_argument("--output", metavar="FILENAME", help="Also save results as json")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--child":
+        child(sys.argv[2], sys.argv[3:])
+    else:
+        main(A.parse_args())
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+import os
+import sqlite3
+
+from utils import catch_up, format_date, parse_date_string
+
+"""
+A full-text index over every stored puzzle's clues and answers, plus the
+puzzles' date, weekday, size and constructors, in DATA_DIR/clues.sqlite3.
+main.py keeps it up to date as puzzles arrive. To search it:
+
+    python3 clueindex.py DATA_DIR --answer OREO
+    python3 clueindex.py DATA_DIR "cookie OR biscuit" --type daily --weekday Sat
+
+Clue text is matched with SQLite FTS5 query syntax (words, "phrases",
+prefix*, AND/OR/NOT).
+"""
+
+FILENAME = "clues.sqlite3"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS puzzles (
+    puzzle_type TEXT NOT NULL,
+    date TEXT NOT NULL,  -- YYYY-MM-DD
+    weekday TEXT NOT NULL,  -- Mon, Tue, ... as in the stats csv
+    width INTEGER,
+    height INTEGER,
+    constructors TEXT,  -- comma separated
+    editor TEXT,
+    PRIMARY KEY (puzzle_type, date)
+) WITHOUT ROWID;
+CREATE VIRTUAL TABLE IF NOT EXISTS clues USING fts5(
+    clue,
+    answer,
+    puzzle_type UNINDEXED,
+    date UNINDEXED,
+    label UNINDEXED,
+    direction UNINDEXED
+);
+"""
+
+# A puzzle's clues get rowids first_rowid(...) + k for its k'th clue, so that
+# reindexing a puzzle can drop its old clues without scanning the table.
+CLUES_PER_PUZZLE = 1000
+
+
+def first_rowid(puzzle_type, date):
+    n = date.toordinal() * 2 + (puzzle_type != "mini")
+    return n * CLUES_PER_PUZZLE
+
+
+def clue_rows(puzzle):
+    """(label, direction, clue, answer) for each clue in a v6 puzzle."""
+    for body in puzzle.get("body", []):
+        cells = body.get("cells", [])
+        for clue in body.get("clues", []):
+            text = clue.get("text") or [{}]
+            answer = "".join(cells[i].get("answer", "") for i in clue.get("cells", []))
+            yield clue.get("label"), clue.get("direction"), text[0].get("plain"), answer
+
+
+class ClueIndex:
+    def __init__(self, directory):
+        self.conn = sqlite3.connect(os.path.join(directory, FILENAME))
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def dates(self, puzzle_type):
+        rows = self.conn.execute(
+            "SELECT date FROM puzzles WHERE puzzle_type=?", [puzzle_type]
+        )
+        return {parse_date_string(d) for (d,) in rows}
+
+    def add(self, puzzle_type, puzzles):
+        """(Re)indexes puzzles, in one transaction."""
+        with self.conn:
+            for p in puzzles:
+                date = parse_date_string(p["publicationDate"])
+                body = (p.get("body") or [{}])[0]
+                size = body.get("dimensions", {})
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO puzzles VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        puzzle_type,
+                        format_date(date),
+                        date.strftime("%a"),
+                        size.get("width"),
+                        size.get("height"),
+                        ", ".join(p.get("constructors", [])),
+                        p.get("editor"),
+                    ),
+                )
+
+                first = first_rowid(puzzle_type, date)
+                self.conn.execute(
+                    "DELETE FROM clues WHERE rowid BETWEEN ? AND ?",
+                    (first, first + CLUES_PER_PUZZLE - 1),
+                )
+                rows = [
+                    (first + k, clue, answer, puzzle_type, format_date(date), label, d)
+                    for k, (label, d, clue, answer) in enumerate(clue_rows(p))
+                ]
+                self.conn.executemany(
+                    "INSERT INTO clues (rowid, clue, answer, puzzle_type, date, label, "
+                    "direction) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+
+    def update(self, store, puzzle_type):
+        """Indexes the puzzles store has that the index doesn't (see
+        utils.catch_up).
+        """
+        return catch_up(self, store, puzzle_type)
+
+    def search(
+        self,
+        text=None,
+        answer=None,
+        puzzle_type=None,
+        weekday=None,
+        since=None,
+        until=None,
+        constructor=None,
+        size=None,
+        limit=100,
+    ):
+        """Clues matching every filter given, newest first, as dicts. text and
+        answer use FTS5 query syntax; constructor matches any part of a name.
+        """
+        match = []
+        if text:
+            match.append("clue : (%s)" % text)
+        if answer:
+            match.append("answer : (%s)" % answer)
+
+        where, args = puzzle_filters(
+            puzzle_type, weekday, since, until, constructor, size
+        )
+        if match:
+            where.append("clues MATCH ?")
+            args.append(" AND ".join(match))
+        sql = (
+            "SELECT p.date, p.puzzle_type, p.weekday, c.label, c.direction, c.clue, "
+            "c.answer, p.constructors FROM clues c JOIN puzzles p "
+            "ON p.puzzle_type = c.puzzle_type AND p.date = c.date"
+        )
+        sql += " WHERE " + " AND ".join(where) if where else ""
+        sql += " ORDER BY p.date DESC LIMIT ?"
+        keys = "date puzzle_type weekday label direction clue answer constructors"
+        rows = self.conn.execute(sql, args + [limit])
+        return [dict(zip(keys.split(), r)) for r in rows]
+
+    def puzzles(
+        self,
+        puzzle_type=None,
+        weekday=None,
+        since=None,
+        until=None,
+        constructor=None,
+        size=None,
+        limit=100,
+    ):
+        """Puzzles matching every filter given, newest first, as dicts."""
+        where, args = puzzle_filters(
+            puzzle_type, weekday, since, until, constructor, size
+        )
+        sql = "SELECT * FROM puzzles p"
+        sql += " WHERE " + " AND ".join(where) if where else ""
+        sql += " ORDER BY date DESC LIMIT ?"
+        cursor = self.conn.execute(sql, args + [limit])
+        keys = [c[0] for c in cursor.description]
+        return [dict(zip(keys, r)) for r in cursor]
+
+
+def puzzle_filters(puzzle_type, weekday, since, until, constructor, size):
+    filters = [
+        ("p.puzzle_type = ?", puzzle_type),
+        ("p.weekday = ?", weekday),
+        ("p.date >= ?", since and format_date(since)),
+        ("p.date <= ?", until and format_date(until)),
+        ("p.constructors LIKE ?", constructor and "%" + constructor + "%"),
+        ("p.width = ?", size),
+    ]
+    where = [sql for sql, value in filters if value is not None]
+    args = [value for sql, value in filters if value is not None]
+    return where, args
+
+
+def main(args):
+    index = ClueIndex(args.data_dir)
+    filters = dict(
+        puzzle_type=args.type,
+        weekday=args.weekday,
+        since=args.since,
+        until=args.until,
+        constructor=args.constructor,
+        size=args.size,
+        limit=args.limit,
+    )
+    if args.text or args.answer:
+        for c in index.search(args.text, args.answer, **filters):
+            print(
+                "%(date)s %(weekday)s %(puzzle_type)-5s %(label)3s%(direction).1s "
+                "%(answer)-15s %(clue)s" % c
+            )
+    else:
+        for p in index.puzzles(**filters):
+            print(
+                "%(date)s %(weekday)s %(puzzle_type)-5s %(width)sx%(height)s "
+                "%(constructors)s" % p
+            )
+
+
+A = ArgumentParser(
+    description="Searches the clue index main.py keeps in DATA_DIR. With no "
+    "text or answer, lists the puzzles that match the other filters.",
+    formatter_class=ArgumentDefaultsHelpFormatter,
+)
+A.add_argument("data_dir")
+A.add_argument("text", nargs="?", help="Words to look for in clues")
+A.add_argument("-a", "--answer", help="An answer (or answer prefix*)")
+A.add_argument("-t", "--type", choices=["daily", "mini"])
+A.add_argument("-w", "--weekday", help="Mon, Tue, ...")
+A.add_argument("--since", type=parse_date_string, help="YYYY-MM-DD")
+A.add_argument("--until", type=parse_date_string, help="YYYY-MM-DD")
+A.add_argument("-c", "--constructor", help="Any part of a constructor's name")
+A.add_argument("--size", type=int, help="Grid width, eg 15 or 21")
+A.add_argument("-n", "--limit", type=int, default=50)
+
+
+if __name__ == "__main__":
+    main(A.parse_args())
@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
+import hashlib
 import json
+import os
 import sys
+import time
 
 """
 Cookie Utils
@@ -39,6 +42,49 @@ def save_cookie(cookie, filename):
     print("\nSaved %s to %s." % (list(cookie.keys())[0], filename))
 
 
+USER_IDS = "user-ids.json"
+
+
+def fingerprint(filename):
+    """Identifies a cookie file by its contents, so a new cookie gets a new
+    fingerprint.
+    """
+    with open(filename, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+
+def cached_user_id(directory, filename, max_age=7 * 24 * 60 * 60):
+    """The user id (regiId) last seen for the cookie in filename, if it was
+    seen within max_age seconds (None: any age), else None.
+    """
+    try:
+        with open(os.path.join(directory, USER_IDS)) as f:
+            user_ids = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    entry = user_ids.get(fingerprint(filename))
+    if entry is None:
+        return None
+    if max_age is not None and time.time() - entry["saved"] > max_age:
+        return None
+    return entry["regiId"]
+
+
+def save_user_id(directory, filename, user_id):
+    path = os.path.join(directory, USER_IDS)
+    try:
+        with open(path) as f:
+            user_ids = json.load(f)
+    except FileNotFoundError:
+        user_ids = {}
+
+    user_ids[fingerprint(filename)] = {"regiId": user_id, "saved": int(time.time())}
+    os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(user_ids, f, indent=4)
+
+
 def main(filename):
     """Need to get an NYT Login Cookie (NYT-S), easiest way is in Chrome:
     1. Open Developer Tools | Network
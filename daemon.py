@@ -0,0 +1,83 @@
+import time
+import traceback
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from utils import date_range
+
+
+class Releases:
+    """When puzzles come out. The puzzle for a date is released the evening
+    before: at `weekday` time, or `weekend` time when that evening falls on
+    a Saturday or Sunday. Times are "HH:MM" in `timezone`.
+    """
+
+    def __init__(self, config):
+        self.tz = ZoneInfo(config.get("timezone", "America/New_York"))
+        self.weekday = parse_time(config.get("weekday", "22:00"))
+        self.weekend = parse_time(config.get("weekend", "18:00"))
+
+    def release(self, date):
+        eve = date - timedelta(1)
+        hour, minute = self.weekend if eve.weekday() >= 5 else self.weekday
+        return datetime(eve.year, eve.month, eve.day, hour, minute, tzinfo=self.tz)
+
+    def latest(self, now):
+        """The date (as a naive midnight datetime, like the rest of the DB)
+        of the newest puzzle released by now.
+        """
+        local = now.astimezone(self.tz)
+        date = datetime(local.year, local.month, local.day) + timedelta(1)
+        while self.release(date) > now:
+            date -= timedelta(1)
+        return date
+
+    def next(self, now):
+        return self.release(self.latest(now) + timedelta(1))
+
+
+def parse_time(s):
+    hour, minute = s.split(":")
+    return int(hour), int(minute)
+
+
+def run(sync, releases, config, begin=None):
+    """Calls sync(drange) at each release, and every daemon-refresh seconds
+    between them, over the last daemon-lookback days (but not before begin):
+    the new puzzle, and stats for recent puzzles that may since have been
+    solved (the unsolved cache decides how often each is actually asked
+    about). A sync that fails is logged and tried again after a wait that
+    doubles from daemon-backoff seconds with each failure in a row, up to
+    daemon-refresh.
+    """
+    refresh = timedelta(seconds=config.get("daemon-refresh", 60 * 60))
+    lookback = timedelta(days=config.get("daemon-lookback", 7))
+    # Give the server a moment to publish before asking.
+    settle = timedelta(seconds=config.get("daemon-settle", 30))
+    backoff = timedelta(seconds=config.get("daemon-backoff", 60))
+
+    failures = 0
+    try:
+        while True:
+            now = datetime.now(timezone.utc)
+            latest = releases.latest(now)
+            start = latest - lookback
+            if begin is not None:
+                start = max(start, begin)
+            try:
+                sync(date_range(start, latest))
+                failures = 0
+            except Exception:
+                failures += 1
+                print("Sync failed (%d in a row):" % failures)
+                traceback.print_exc()
+
+            now = datetime.now(timezone.utc)
+            wait = refresh
+            if failures:
+                wait = min(refresh, backoff * 2 ** (failures - 1))
+            wake = min(releases.next(now) + settle, now + wait)
+            print("Sleeping until %s" % wake.astimezone().strftime("%Y-%m-%d %H:%M"))
+            time.sleep(max(0, (wake - now).total_seconds()))
+    except KeyboardInterrupt:
+        print("Stopped")
@@ -1,18 +1,26 @@
 import json
 import os
 import pathlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-from utils import parse_date_string
+from metrics import METRICS
+from utils import atomic_write, parse_date_string
 
 
 class DataDir:
-    # TODO: consider storing data in a dictionary {date: json}
-    def __init__(self, directory, basename):
-        os.makedirs(directory, exist_ok=True)
+    WRITERS = 8
+
+    def __init__(self, directory, basename, indent=4, readonly=False):
+        """indent: for the json files; None writes them compactly.
+        readonly: don't create directory.
+        """
+        if not readonly:
+            os.makedirs(directory, exist_ok=True)
         self.directory = pathlib.Path(directory)
         self.basename = basename
-        self.data = None
+        self.indent = indent
+        self.index = {}  # {date: path}, filled by read
 
     def date_to_path(self, dt, ensure_exists=True):
         month, day = ("%02d" % s for s in [dt.month, dt.day])
@@ -33,15 +41,35 @@ class DataDir:
         day = filename[n : n + 2]
         return datetime(int(year), int(month), int(day))
 
+    def paths(self):
+        """All document paths in the YYYY/MM/basename-DD.json layout."""
+        pattern = "*/*/%s-*.json" % self.basename
+        return sorted(self.directory.glob(pattern))
+
     def read(self, begin):
-        data = []
-        for path in sorted(pathlib.Path(self.directory).rglob("*.json")):
+        """Indexes the documents on or after begin by their path alone.
+        Nothing is decoded here; use load or documents to get at the json.
+        """
+        index = {}
+        for path in self.paths():
             date = self.path_to_date(path)
             if begin <= date:
-                with open(path) as f:
-                    data.append(json.load(f))
-        self.data = data
-        return data
+                index[date] = path
+        self.index = index
+        return index
+
+    @METRICS.timed("datadir.load")
+    def load(self, date):
+        with open(self.index[date]) as f:
+            return json.load(f)
+
+    def dates(self):
+        return sorted(self.index)
+
+    def documents(self):
+        """Lazily yields the indexed documents in date order."""
+        for date in sorted(self.index):
+            yield self.load(date)
 
     def _get_date(self, d):
         """Get a date from a dict representing either a puzzle or stats."""
@@ -50,12 +78,38 @@ class DataDir:
         return parse_date_string(date_str)
 
     def missing_days(self, dates):
-        have_dates = {self._get_date(d) for d in self.data}
-        return [d for d in dates if d not in have_dates]
+        return [d for d in dates if d not in self.index]
+
+    def remove(self, dates):
+        """Sets the documents at dates aside, as {path}.bad, so that they
+        count as missing (and get fetched again).
+        """
+        for date in dates:
+            path = self.index.pop(date)
+            os.replace(path, path.with_name(path.name + ".bad"))
 
+    @METRICS.timed("datadir.write")
     def write(self, data):
+        """Writes a file per document, several at once. Each goes to a temp
+        file that's then renamed into place, so a crash can't leave half a
+        document behind.
+        """
+        paths = {}
         for d in data:
             date = self._get_date(d)
-            path = self.date_to_path(date)
-            with open(path, "w") as f:
-                json.dump(d, f, indent=4)
+            paths[date] = (self.date_to_path(date, ensure_exists=False), d)
+        for parent in {path.parent for (path, _) in paths.values()}:
+            os.makedirs(parent, exist_ok=True)
+
+        def write_one(item):
+            path, d = item
+            # dumps (unlike dump) can use the C encoder, when not indenting.
+            text = json.dumps(d, indent=self.indent)
+            with atomic_write(path) as f:
+                f.write(text)
+
+        with ThreadPoolExecutor(min(DataDir.WRITERS, len(paths) or 1)) as pool:
+            # list() re-raises any worker's exception here.
+            list(pool.map(write_one, paths.values()))
+        for date, (path, _) in paths.items():
+            self.index[date] = path
@@ -1,7 +1,12 @@
 import os
 
+from metrics import METRICS
+
 from statsfile import StatsFile
 from datadir import DataDir
+from packdir import PackDir
+from sqlitestore import SqliteStore, connect
+from watermark import Watermarks
 
 
 class Data:
@@ -21,8 +26,29 @@ class Puzzle:
         return [Puzzle.MINI, Puzzle.DAILY]
 
 
+class Storage:
+    FILES = "files"
+    PACK = "pack"
+    SQLITE = "sqlite"
+
+    def types():
+        return [Storage.FILES, Storage.PACK, Storage.SQLITE]
+
+
 class DB:
-    def __init__(self, directory, puzzle_types, stat_kinds, puzzles, uid):
+    SQLITE_FILE = "xwdata.sqlite3"
+
+    def __init__(
+        self,
+        directory,
+        puzzle_types,
+        stat_kinds,
+        puzzles,
+        uid,
+        storage=Storage.FILES,
+        indent=4,
+        readonly=False,
+    ):
         """Args:
         directory: to read/write from/to; created if it doesn't exist.
         begin: datetime at which to begin (don't read data before this date)
@@ -30,14 +56,21 @@ class DB:
         stat_kinds: list with one or both of ['stats', 'full_stats']
         puzzles: bool telling whether we want to get the puzzles
         uid: user_id for stats
+        storage: Storage.FILES (csv + json trees), Storage.PACK (csv + packed
+            monthly archives, see packdir) or Storage.SQLITE (one file)
+        indent: for Storage.FILES json documents; None writes them compactly
+        readonly: only read and report: nothing is created, and watermarks
+            and rollups are kept up to date in memory but not saved
         """
-        os.makedirs(directory, exist_ok=True)
+        if not readonly:
+            os.makedirs(directory, exist_ok=True)
         self.dir = directory
 
+        docs = PackDir if storage == Storage.PACK else DataDir
         constructors = {
-            Data.FULL_STATS: lambda r: DataDir(r, Data.STATS),
-            Data.PUZZLE: lambda r: DataDir(r, Data.PUZZLE),
-            Data.STATS: StatsFile,
+            Data.FULL_STATS: lambda r: docs(r, Data.STATS, indent, readonly),
+            Data.PUZZLE: lambda r: docs(r, Data.PUZZLE, indent, readonly),
+            Data.STATS: lambda r: StatsFile(r, readonly=readonly),
         }
         root = {
             Data.FULL_STATS: os.path.join(uid, Data.FULL_STATS),
@@ -46,32 +79,69 @@ class DB:
         }
         ending = {Data.STATS: ".csv"}
 
+        if storage == Storage.SQLITE:
+            conn = connect(os.path.join(directory, DB.SQLITE_FILE), readonly)
+
         dbs = {}
         kinds = stat_kinds + [Data.PUZZLE] if puzzles else stat_kinds
         for k in kinds:
             dbs[k] = {}
             new = constructors[k]
             for p in puzzle_types:
-                path = os.path.join(directory, root[k], p) + ending.get(k, "")
-                dbs[k][p] = new(path)
+                if storage == Storage.SQLITE:
+                    user = "" if k == Data.PUZZLE else uid
+                    dbs[k][p] = SqliteStore(conn, user, p, k, rows=k == Data.STATS)
+                else:
+                    path = os.path.join(directory, root[k], p) + ending.get(k, "")
+                    dbs[k][p] = new(path)
         self.dbs = dbs
+        self.storage = storage
+        self.readonly = readonly
+        self.watermarks = Watermarks(os.path.join(directory, uid, "watermarks.json"))
 
     def read(self, begin):
         for kind in self.dbs:
-            for ptype in self.dbs[kind]:
-                self.dbs[kind][ptype].read(begin)
+            with METRICS.phase("db.read.%s" % kind):
+                for ptype in self.dbs[kind]:
+                    self.dbs[kind][ptype].read(begin)
 
     def missing_days(self, dates, data_kind, puzzle_type):
-        return self.dbs[data_kind][puzzle_type].missing_days(dates)
+        """dates: a contiguous, sorted range (see utils.date_range). Only the
+        ones the watermark can't vouch for are looked up.
+        """
+        # Each storage has its own: converting one doesn't fill the others.
+        key = "%s %s %s" % (self.storage, data_kind, puzzle_type)
+        candidates = self.watermarks.candidates(key, dates)
+        missing = self.dbs[data_kind][puzzle_type].missing_days(candidates)
+        self.watermarks.update(key, dates, missing)
+        if not self.readonly:
+            self.watermarks.save()
+        return missing
+
+    def rescan(self):
+        """Forgets the watermarks, so that missing_days checks every date again
+        (eg after files were deleted by hand).
+        """
+        self.watermarks.clear()
 
     def store(self, data, kind_or_kinds, puzzle_type):
         match kind_or_kinds:
             case str():
                 if kind_or_kinds != Data.PUZZLE:
                     raise TypeError("Unsupported type")
-                self.dbs[kind_or_kinds][puzzle_type].write(data)
+                with METRICS.phase("db.store.%s" % kind_or_kinds):
+                    self.dbs[kind_or_kinds][puzzle_type].write(data)
             case list():
                 for stat in kind_or_kinds:
-                    self.dbs[stat][puzzle_type].write(data)
+                    with METRICS.phase("db.store.%s" % stat):
+                        self.dbs[stat][puzzle_type].write(data)
             case _:
                 raise TypeError("Unsupported type")
+
+    def compact(self):
+        """Folds append logs (see StatsFile) back into their files."""
+        for kind in self.dbs:
+            for ptype in self.dbs[kind]:
+                store = self.dbs[kind][ptype]
+                if hasattr(store, "compact"):
+                    store.compact()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from datetime import date, datetime
+
+import os
+import struct
+
+from utils import catch_up
+
+"""
+Puzzle grids packed for analysis with NumPy, in DATA_DIR/grids/. For each
+puzzle type, {type}.cells holds every grid's cells back to back, a byte per
+cell (0 for a block, else the answer's first letter), and {type}.index a
+fixed-size record per puzzle: (date ordinal, height, width, offset into
+cells). Both are only ever appended to, so keeping them up to date costs
+just the new puzzles. Writing needs only the standard library; Grids, for
+reading and analysis, needs numpy.
+
+    python3 grids.py DATA_DIR
+"""
+
+RECORD = struct.Struct("<iHHq")  # day, height, width, offset
+BLOCK = 0
+
+
+def encode(puzzle):
+    """(height, width, cells as bytes) for a v6 puzzle. Rebus squares keep
+    only their first letter.
+    """
+    body = puzzle["body"][0]
+    size = body["dimensions"]
+    cells = bytes(
+        ord(c["answer"][0].upper()) if c.get("answer") else BLOCK for c in body["cells"]
+    )
+    return size["height"], size["width"], cells
+
+
+class GridStore:
+    def __init__(self, directory):
+        self.directory = os.path.join(directory, "grids")
+        os.makedirs(self.directory, exist_ok=True)
+        self.days = {}  # {puzzle_type: set of date ordinals stored}
+
+    def path(self, puzzle_type, ext):
+        return os.path.join(self.directory, "%s.%s" % (puzzle_type, ext))
+
+    def records(self, puzzle_type):
+        try:
+            with open(self.path(puzzle_type, "index"), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        # A write cut short can leave half a record at the end.
+        data = data[: len(data) - len(data) % RECORD.size]
+        return list(RECORD.iter_unpack(data))
+
+    def dates(self, puzzle_type):
+        if puzzle_type not in self.days:
+            self.days[puzzle_type] = {r[0] for r in self.records(puzzle_type)}
+        return {datetime.fromordinal(d) for d in self.days[puzzle_type]}
+
+    def add(self, puzzle_type, puzzles):
+        """Appends the puzzles not stored yet; cells go first, so an index
+        record never points past the end of them.
+        """
+        have = self.days.setdefault(puzzle_type, set())
+        if not have:
+            have.update(r[0] for r in self.records(puzzle_type))
+
+        records = []
+        with open(self.path(puzzle_type, "cells"), "ab") as f:
+            for p in puzzles:
+                day = date.fromisoformat(p["publicationDate"]).toordinal()
+                if day in have:
+                    continue
+                height, width, cells = encode(p)
+                records.append(RECORD.pack(day, height, width, f.tell()))
+                f.write(cells)
+                have.add(day)
+        with open(self.path(puzzle_type, "index"), "ab") as f:
+            f.write(b"".join(records))
+
+    def update(self, store, puzzle_type):
+        """Adds the puzzles store has that aren't here yet (see
+        utils.catch_up).
+        """
+        return catch_up(self, store, puzzle_type)
+
+    def load(self, puzzle_type):
+        """The puzzle_type's grids, as Grids. Needs numpy."""
+        import numpy as np
+
+        dtype = [("day", "<i4"), ("height", "<u2"), ("width", "<u2"), ("offset", "<i8")]
+        index = np.array(self.records(puzzle_type), dtype=dtype)
+        try:
+            cells = np.memmap(self.path(puzzle_type, "cells"), dtype=np.uint8, mode="r")
+        except (FileNotFoundError, ValueError):  # ValueError: an empty file
+            cells = np.zeros(0, dtype=np.uint8)
+        return Grids(index, cells)
+
+
+class Grids:
+    """Batched analytics over a set of grids. Per-puzzle results are arrays
+    in the order of self.day; grids of one shape are worked on together, as
+    a (puzzles, height, width) tensor.
+    """
+
+    def __init__(self, index, cells):
+        import numpy as np
+
+        self.np = np
+        order = np.argsort(index["day"], kind="stable")
+        self.index = index[order]
+        self.cells = cells
+        self.day = self.index["day"]
+
+    def __len__(self):
+        return len(self.index)
+
+    def weekday(self):
+        """0 for Monday, as date.weekday()."""
+        return (self.day - 1) % 7
+
+    def shapes(self):
+        """{(height, width): positions in self.day of the grids of that shape}"""
+        np = self.np
+        shape = self.index["height"].astype(np.int64) << 16 | self.index["width"]
+        return {
+            (int(s >> 16), int(s & 0xFFFF)): np.flatnonzero(shape == s)
+            for s in np.unique(shape)
+        }
+
+    def stack(self, height, width, which):
+        """The grids at positions which (all height x width) as a tensor."""
+        np = self.np
+        offsets = self.index["offset"][which].astype(np.int64)
+        cells = offsets[:, None] + np.arange(height * width)
+        return self.cells[cells].reshape(len(which), height, width)
+
+    def per_shape(self, f, dtype):
+        """Calls f(tensor) for each shape, scattering its per-grid results."""
+        out = self.np.zeros(len(self), dtype=dtype)
+        for (height, width), which in self.shapes().items():
+            out[which] = f(self.stack(height, width, which))
+        return out
+
+    def block_density(self):
+        return self.per_shape(lambda g: (g == BLOCK).mean(axis=(1, 2)), float)
+
+    def symmetric(self):
+        """Whether each grid's blocks have 180-degree rotational symmetry."""
+        np = self.np
+
+        def f(g):
+            blocks = g == BLOCK
+            return np.all(blocks == blocks[:, ::-1, ::-1], axis=(1, 2))
+
+        return self.per_shape(f, bool)
+
+    def word_lengths(self):
+        """(puzzles, longest + 1) array: how many entries of each length
+        (across and down, 2 letters and up) each grid has.
+        """
+        np = self.np
+        longest = max([max(s) for s in self.shapes()] or [0])
+        counts = np.zeros((len(self), longest + 1), dtype=np.int64)
+        for (height, width), which in self.shapes().items():
+            open_ = self.stack(height, width, which) != BLOCK
+            for runs in (open_, open_.transpose(0, 2, 1)):
+                # Runs of open cells start where a row steps up and end
+                # where it steps down; nonzero lists both in the same order.
+                padded = np.pad(runs, ((0, 0), (0, 0), (1, 1))).astype(np.int8)
+                steps = np.diff(padded, axis=2)
+                grid, _, start = np.nonzero(steps == 1)
+                _, _, end = np.nonzero(steps == -1)
+                length = end - start
+                words = length >= 2
+                np.add.at(counts, (which[grid[words]], length[words]), 1)
+        return counts
+
+    def letter_counts(self):
+        """{letter: count} over every answer in every grid."""
+        np = self.np
+        counts = np.zeros(256, dtype=np.int64)
+        for (height, width), which in self.shapes().items():
+            grids = self.stack(height, width, which)
+            counts += np.bincount(grids.ravel(), minlength=256)
+        return {chr(c): int(counts[c]) for c in np.flatnonzero(counts) if c != BLOCK}
+
+
+def main(args):
+    from db import DB, Data
+
+    database = DB(args.data_dir, args.types, [], True, "", args.storage)
+    database.read(datetime.min)
+    store = GridStore(args.data_dir)
+    weekdays = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+    for ptype in args.types:
+        n = store.update(database.dbs[Data.PUZZLE][ptype], ptype)
+        grids = store.load(ptype)
+        print("%s: %d grids (%d new)" % (ptype, len(grids), n))
+        if not len(grids):
+            continue
+
+        density, symmetric = grids.block_density(), grids.symmetric()
+        lengths = grids.word_lengths()
+        words = lengths.sum(axis=1)
+        mean_length = (lengths * range(lengths.shape[1])).sum(axis=1) / words
+        weekday = grids.weekday()
+        print("  %-4s%8s%10s%8s%10s" % ("", "grids", "blocks", "words", "avg len"))
+        for i, name in enumerate(weekdays):
+            on = weekday == i
+            if on.any():
+                print(
+                    "  %-4s%8d%9.1f%%%8.1f%10.2f"
+                    % (
+                        name,
+                        on.sum(),
+                        100 * density[on].mean(),
+                        words[on].mean(),
+                        mean_length[on].mean(),
+                    )
+                )
+        print("  %.1f%% rotationally symmetric" % (100 * symmetric.mean()))
+        total = lengths.sum(axis=0)
+        print(
+            "  Entries by length: %s"
+            % ", ".join("%d: %d" % (k, n) for k, n in enumerate(total) if n)
+        )
+
+
+A = ArgumentParser(
+    description="Brings the grid store up to date and prints a summary.",
+    formatter_class=ArgumentDefaultsHelpFormatter,
+)
+A.add_argument("data_dir")
+A.add_argument("--storage", choices=["files", "pack", "sqlite"], default="files")
+A.add_argument(
+    "--types", nargs="+", choices=["mini", "daily"], default=["mini", "daily"]
+)
+
+
+if __name__ == "__main__":
+    main(A.parse_args())
@@ -0,0 +1,280 @@
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlencode
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from metrics import METRICS
+from utils import atomic_write
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,  -- see HttpCache.key
+    url TEXT NOT NULL,
+    body TEXT NOT NULL,  -- sha256 of the body, which is in bodies/
+    headers TEXT NOT NULL,  -- json: the validators and content type
+    stored REAL NOT NULL,  -- when last fetched or revalidated
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE INDEX IF NOT EXISTS entries_body ON entries (body);
+CREATE TABLE IF NOT EXISTS bodies (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL
+);
+"""
+
+# Response headers worth keeping.
+HEADERS = ["Content-Type", "ETag", "Last-Modified"]
+
+
+def parse_ttl(value):
+    """cache-ttl from the config: seconds, or 'forever'."""
+    return math.inf if value == "forever" else float(value)
+
+
+class Rule:
+    """How to cache the responses from urls starting with prefix: for ttl
+    seconds without asking again, then revalidating; per_user responses are
+    cached separately for each set of cookies.
+    """
+
+    def __init__(self, prefix, ttl, per_user):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.per_user = per_user
+
+
+def rules(config):
+    """A Rule for each endpoint in the api config with a cache-ttl."""
+    found = []
+    for name in ["info", "stats", "puzzle"]:
+        endpoint = config[name]
+        if "cache-ttl" not in endpoint:
+            continue
+        prefix = endpoint["url"].split("{")[0]
+        ttl = parse_ttl(endpoint["cache-ttl"])
+        found.append(Rule(prefix, ttl, endpoint.get("cache-per-user", False)))
+    return found
+
+
+class HttpCache:
+    """Responses kept on disk across runs (and users, where they're the same):
+    bodies are stored once per distinct content under bodies/, named by their
+    sha256; entries.sqlite3 maps each request to its body, validators and
+    age. Once over max_bytes, the least recently used entries go.
+    """
+
+    def __init__(self, directory, rules, max_bytes):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, "bodies"), exist_ok=True)
+        self.rules = sorted(rules, key=lambda r: len(r.prefix), reverse=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            os.path.join(directory, "entries.sqlite3"), check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        (total,) = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM bodies"
+        ).fetchone()
+        self.total = total
+
+    def rule(self, url):
+        for r in self.rules:
+            if url.startswith(r.prefix):
+                return r
+        return None
+
+    def key(self, rule, url, params=None, cookies=None):
+        parts = [url, urlencode(sorted((params or {}).items()))]
+        if rule.per_user:
+            parts.append(json.dumps(cookies or {}, sort_keys=True))
+        return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+    def body_path(self, digest):
+        return os.path.join(self.directory, "bodies", digest[:2], digest)
+
+    def lookup(self, key):
+        """(body, headers, age in seconds) for key, or None."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT body, headers, stored FROM entries WHERE key=?", [key]
+            ).fetchone()
+            if row is None:
+                return None
+            digest, headers, stored = row
+            try:
+                with open(self.body_path(digest), "rb") as f:
+                    body = f.read()
+            except FileNotFoundError:
+                with self.conn:
+                    self.conn.execute("DELETE FROM entries WHERE key=?", [key])
+                return None
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE entries SET accessed=? WHERE key=?", [time.time(), key]
+                )
+            return body, json.loads(headers), time.time() - stored
+
+    def store(self, key, url, body, headers):
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.body_path(digest)
+        kept = {k: headers[k] for k in HEADERS if k in headers}
+        now = time.time()
+        with self.lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with atomic_write(path, "wb") as f:
+                    f.write(body)
+            with self.conn:
+                new = self.conn.execute(
+                    "INSERT OR IGNORE INTO bodies VALUES (?, ?)", [digest, len(body)]
+                ).rowcount
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                    [key, url, digest, json.dumps(kept), now, now],
+                )
+            self.total += len(body) if new else 0
+            if self.total > self.max_bytes:
+                self.evict()
+
+    def refresh(self, key):
+        """Marks key's entry as just revalidated."""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE entries SET stored=? WHERE key=?", [time.time(), key]
+            )
+
+    def evict(self):
+        """Drops least recently used entries, and bodies nothing else uses,
+        until the cache is a tenth under max_bytes. Call with the lock held.
+        """
+        target = self.max_bytes * 0.9
+        entries = self.conn.execute("SELECT key, body FROM entries ORDER BY accessed")
+        with self.conn:
+            for key, digest in entries.fetchall():
+                if self.total <= target:
+                    break
+                METRICS.count("cache_evicted_bytes", self.drop(key, digest))
+
+    def drop(self, key, digest):
+        """Deletes key's entry, and its body if nothing else uses it; returns
+        the bytes freed. Call with the lock held, in a transaction.
+        """
+        self.conn.execute("DELETE FROM entries WHERE key=?", [key])
+        used = self.conn.execute(
+            "SELECT 1 FROM entries WHERE body=? LIMIT 1", [digest]
+        ).fetchone()
+        if used:
+            return 0
+        (size,) = self.conn.execute(
+            "SELECT size FROM bodies WHERE hash=?", [digest]
+        ).fetchone()
+        self.conn.execute("DELETE FROM bodies WHERE hash=?", [digest])
+        try:
+            os.remove(self.body_path(digest))
+        except FileNotFoundError:
+            pass
+        self.total -= size
+        return size
+
+    def forget(self, urls):
+        """Drops every entry for urls (for any params or user), eg when what
+        they returned turned out to be bad.
+        """
+        with self.lock, self.conn:
+            for url in urls:
+                rows = self.conn.execute(
+                    "SELECT key, body FROM entries WHERE url=?", [url]
+                )
+                for key, digest in rows.fetchall():
+                    self.drop(key, digest)
+
+    def request(self, url, params=None, cookies=None):
+        """A Request to look url up with, or None if it isn't cached."""
+        rule = self.rule(url)
+        if rule is None:
+            return None
+        key = self.key(rule, url, params, cookies)
+        return Request(self, key, url, rule.ttl, self.lookup(key))
+
+    def get(self, session, url, send, params=None):
+        """A requests.Response for url, from the cache where it's fresh, else
+        from send(headers), which makes the request with the headers given
+        (validators, when there's an entry to revalidate).
+        """
+        request = self.request(url, params, session.cookies.get_dict())
+        if request is None:
+            return send({})
+        if request.fresh:
+            return to_response(url, request.hit(), request.headers)
+
+        response = send(request.validators())
+        if response.status_code == 304 and request.cached:
+            return to_response(url, request.revalidated(), request.headers)
+        if response.status_code == 200:
+            request.save(response.content, response.headers)
+        return response
+
+
+class Request:
+    """One url's entry in an HttpCache (cached is None if there isn't one),
+    for the steps of a fetch that may be served from it.
+    """
+
+    def __init__(self, cache, key, url, ttl, cached):
+        self.cache = cache
+        self.key = key
+        self.url = url
+        self.cached = cached
+        self.body, self.headers, age = cached or (None, {}, math.inf)
+        self.fresh = cached is not None and age < ttl
+
+    def validators(self):
+        """Request headers that ask the server for a 304 if nothing changed."""
+        conditional = {}
+        if "ETag" in self.headers:
+            conditional["If-None-Match"] = self.headers["ETag"]
+        if "Last-Modified" in self.headers:
+            conditional["If-Modified-Since"] = self.headers["Last-Modified"]
+        return conditional
+
+    def hit(self):
+        METRICS.count("cache_hits")
+        return self.body
+
+    def revalidated(self):
+        """The server said (304) the cached body is still good."""
+        METRICS.count("cache_revalidated")
+        self.cache.refresh(self.key)
+        return self.body
+
+    def save(self, body, headers):
+        METRICS.count("cache_misses")
+        self.cache.store(self.key, self.url, body, headers)
+
+
+def to_response(url, body, headers):
+    """A cached body dressed up as the requests.Response it came from."""
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.headers = CaseInsensitiveDict(headers)
+    response._content = body
+    response.encoding = "utf-8"
+    return response
+
+
+def from_config(directory, config):
+    """An HttpCache in directory, per the api config."""
+    size = config["general"].get("cache-size-mb", 500)
+    return HttpCache(directory, rules(config), size * 1024 * 1024)
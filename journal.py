@@ -0,0 +1,67 @@
+import json
+import os
+import pathlib
+
+
+class Journal:
+    """Records which urls a run has pending, done or failed, so that an
+    interrupted run can pick up where it stopped. Stored as json lines in
+    the data dir; the last line for a url wins.
+    """
+
+    PENDING = "pending"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, directory, name="journal.jsonl"):
+        self.path = pathlib.Path(directory, name)
+        self.entries = {}  # {url: {"status": str, ...}}
+        self.load()
+        self.f = open(self.path, "a")
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # a line torn by a crash mid-write
+                    self.entries[entry.pop("url")] = entry
+        except FileNotFoundError:
+            pass
+
+    def count(self, status):
+        return sum(1 for e in self.entries.values() if e["status"] == status)
+
+    def status(self, url):
+        return self.entries.get(url, {}).get("status")
+
+    def record(self, urls, status, **extra):
+        for url in urls:
+            self.entries[url] = {"status": status, **extra}
+            self.f.write(json.dumps({"url": url, "status": status, **extra}) + "\n")
+        self.f.flush()
+
+    def pending(self, urls):
+        """Marks urls pending, skipping (and returning without) those done."""
+        todo = [u for u in urls if self.status(u) != Journal.DONE]
+        self.record(todo, Journal.PENDING)
+        return todo
+
+    def done(self, urls):
+        self.record(urls, Journal.DONE)
+
+    def failed(self, url, reason):
+        self.record([url], Journal.FAILED, reason=str(reason))
+
+    def close(self):
+        """Ends a run that completed: only failures are worth keeping."""
+        self.f.close()
+        failed = {u: e for u, e in self.entries.items() if e["status"] == Journal.FAILED}
+        if not failed:
+            os.remove(self.path)
+            return
+        with open(self.path, "w") as f:
+            for url, entry in failed.items():
+                f.write(json.dumps({"url": url, **entry}) + "\n")
@@ -4,18 +4,24 @@ from argparse import (
     ArgumentDefaultsHelpFormatter,
     BooleanOptionalAction as boolopt,
 )
-from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from tqdm import tqdm
 
 import pathlib
 import os
 
-import api
-from db import DB, Data, Puzzle
-from scraper import Scraper
-from utils import parse_date_string, date_range
-
+# Everything else is imported where it's used: requests and friends are slow
+# to load, and --status needs little of it.
+import cookie
+from db import DB, Data, Puzzle, Storage
+from metrics import METRICS
+from utils import (
+    parse_date_string,
+    format_date,
+    date_range,
+    chunker,
+    interleave,
+    plan_chunks,
+)
 
 A = ArgumentParser(
     description="Retrieves NYT crossword data.",
@@ -40,9 +46,11 @@ A.add_argument(
     "-n",
     "--nyts-cookie",
     action="store",
+    nargs="+",
     type=str,
-    default="cookie.json",
-    help="The path to a cookie.json file containing the NYT-S token",
+    default=["cookie.json"],
+    help="The path to a cookie.json file containing the NYT-S token. "
+    "Give several to sync several users at once, sharing the puzzles",
 )
 A.add_argument(
     "-b",
@@ -52,6 +60,88 @@ A.add_argument(
     default=datetime(2020, 1, 1),
     help="start date (default 2020-1-1). Discards all data before this date.",
 )
+A.add_argument(
+    "--storage",
+    action="store",
+    choices=Storage.types(),
+    default=Storage.FILES,
+    help="How data_dir stores data. See packdir.py and migrate.py to convert "
+    "from files to pack or sqlite",
+)
+A.add_argument(
+    "--compact-json",
+    action="store_true",
+    help="With --storage files, write new json documents without indentation "
+    "(several times smaller, and faster to write)",
+)
+A.add_argument(
+    "--compact",
+    action="store_true",
+    help="Fold the stats append logs back into the csv files after syncing",
+)
+A.add_argument(
+    "--index",  # --no-index
+    action=boolopt,
+    default=True,
+    type=bool,
+    help="Keep the clue index (see clueindex.py) up to date with the puzzles",
+)
+A.add_argument(
+    "--grids",  # --no-grids
+    action=boolopt,
+    default=False,
+    type=bool,
+    help="Keep the packed grid store (see grids.py) up to date with the puzzles",
+)
+A.add_argument(
+    "--cache",  # --no-cache
+    action=boolopt,
+    default=True,
+    type=bool,
+    help="Keep responses in DATA_DIR/http-cache, to reuse across runs and users "
+    "(see the cache-* settings in the config)",
+)
+A.add_argument(
+    "--max-requests",
+    action="store",
+    type=int,
+    metavar="N",
+    help="Stop after about N requests; what's left is fetched by the next run. "
+    "Overrides general.max-requests-per-run (see also the per-day limits there)",
+)
+A.add_argument(
+    "--rescan",
+    action="store_true",
+    help="Look for missing data across the whole date range, rather than only "
+    "after the last sync and in the gaps it left",
+)
+A.add_argument(
+    "--status",
+    action="store_true",
+    help="Without touching the network, print what's missing and the requests "
+    "the next sync would make. Needs a sync to have run once for each cookie",
+)
+A.add_argument(
+    "--daemon",
+    action="store_true",
+    help="After syncing, keep running: fetch each new puzzle as it's released, "
+    "and recent stats every general.daemon-refresh seconds",
+)
+A.add_argument(
+    "--metrics",
+    action="store",
+    metavar="FILENAME",
+    help="Where to write a json report of the run: time per phase, latency "
+    "per endpoint, bytes, retries and rate limit waits. Default: "
+    "DATA_DIR/metrics.json",
+)
+A.add_argument(
+    "--prometheus",
+    action="store",
+    metavar="FILENAME",
+    help="Also write the report in Prometheus text format (eg for "
+    "node_exporter's textfile collector)",
+)
 A.add_argument(
     "-d",
     "--daily",  # --no-daily
@@ -105,12 +195,10 @@ def validate_args(parser):
     if not args.full_stats and not args.puzzle and not args.stats:
         parser.error("Need to specify at least one of full_stats | puzzle | stats")
 
-    if not os.path.exists(args.nyts_cookie):
-        err = (
-            "Can't find %s; Consult README.md and use cookie.py to make it"
-            % args.nyts_cookie
-        )
-        parser.error(err)
+    for cookie_file in args.nyts_cookie:
+        if not os.path.exists(cookie_file):
+            err = "Can't find %s; Consult README.md and use cookie.py to make it"
+            parser.error(err % cookie_file)
 
     if not os.path.exists(args.config):
         parent = pathlib.Path(__file__).parent.resolve()
@@ -123,49 +211,386 @@ def validate_args(parser):
     return args
 
 
-def get(nyt, urls, desc=""):
-    scraper = Scraper(nyt.session, threads=nyt.threads, qps=nyt.qps)
-    with ThreadPoolExecutor(max_workers=nyt.threads) as e:
-        return list(tqdm(e.map(scraper.get, urls), total=len(urls), desc=desc))
+def get_scraper(nyt):
+    from scraper import Scraper
+
+    if nyt.engine == "async":
+        # Only needs aiohttp when it's asked for.
+        from aioscraper import AsyncScraper
+
+        return AsyncScraper(
+            nyt.session,
+            connections=nyt.connections,
+            retry=nyt.retry,
+            limiter=nyt.limiter,
+            cache=nyt.cache,
+        )
+
+    return Scraper(
+        nyt.session,
+        threads=nyt.threads,
+        retry=nyt.retry,
+        limiter=nyt.limiter,
+        cache=nyt.cache,
+    )
+
+
+class User:
+    """Everything a sync needs on behalf of one cookie."""
+
+    def __init__(self, nyt, database, unsolved):
+        self.nyt = nyt
+        self.uid = nyt.user_id
+        self.database = database
+        self.unsolved = unsolved
+
+
+def fetch(nyt, journal, items, to_url, desc="", to_session=None, key=None, budget=None):
+    """Yields (item, response) pairs as responses arrive, in no particular
+    order. At most nyt.queue_size responses are buffered at any time.
+    Items the journal has as done are skipped; failures are journaled.
+    key(item) names an item in the journal (default: its url). Items are
+    requested in order, only while budget (a scheduler.Budget) lasts.
+    """
+    from tqdm import tqdm
+    from retry import FetchError
+
+    key = key or to_url
+    keys = set(journal.pending([key(i) for i in items]))
+    items = [i for i in items if key(i) in keys]
+
+    scraper = get_scraper(nyt)
+    failures = 0
+    total = len(items)
+    if budget:
+        total = min(total, budget.left())
+        items = budget.take(items)
+    responses = scraper.stream(items, to_url, nyt.queue_size, to_session)
+    with tqdm(total=total, desc=desc) as progress_bar:
+        for item, response in responses:
+            progress_bar.update()
+            if isinstance(response, FetchError):
+                journal.failed(key(item), response.reason)
+                failures += 1
+                progress_bar.set_postfix_str("%d failed" % failures)
+            else:
+                yield item, response
+
+
+def sync(
+    nyt, journal, items, to_url, store, desc="", to_session=None, key=None, budget=None
+):
+    """Fetches items, calling store on each batch of (item, response) pairs
+    as they arrive; a batch is journaled as done once it's stored.
+    """
+    key = key or to_url
+    responses = fetch(nyt, journal, items, to_url, desc, to_session, key, budget)
+    for batch in chunker(responses, nyt.batch_size):
+        store(batch)
+        journal.done([key(item) for (item, _) in batch])
+
+
+def missing_puzzles(database, drange, puzzle_types, indexes=()):
+    """Work items for the puzzles database is missing. indexes (a ClueIndex,
+    a GridStore) are first caught up with the puzzles it has.
+    """
+    work = []
+    for ptype in puzzle_types:
+        for index in indexes:
+            # Catches up with puzzles stored before there was an index.
+            name = type(index).__name__
+            with METRICS.phase("%s.update" % name):
+                n = index.update(database.dbs[Data.PUZZLE][ptype], ptype)
+            if n:
+                print("%s: added %d %s puzzles" % (name, n, ptype))
+
+        missing = database.missing_days(drange, Data.PUZZLE, ptype)
+        work.append([(Data.PUZZLE, ptype, None, dt) for dt in missing])
+    return work
+
+
+def dates_to_check(user, drange, stat_kinds, ptype, left):
+    """The dates user is missing stats for that are due a look (see
+    UnsolvedCache), at most left of them: the first in the scheduling order.
+    """
+    import scheduler
+
+    missing = set()
+    for stat in stat_kinds:
+        missing.update(user.database.missing_days(drange, stat, ptype))
+    dates = user.unsolved.stale(ptype, sorted(missing))
+    if left < len(dates):
+        dates = sorted(scheduler.order(dates, lambda d: d, user.nyt.order)[:left])
+    return dates
+
+
+def get_solved(user, dates, ptype, pinfo):
+    """The solved puzzles in pinfo, user's puzzle info for dates, noting the
+    rest as unsolved (without saving the cache).
+    """
+    solved = [p for p in pinfo if p["solved"]]
+    # Only what the server said is unsolved: a chunk that failed returns
+    # nothing, and its dates should be asked about again next run.
+    unsolved = {p["print_date"] for p in pinfo if not p["solved"]}
+    user.unsolved.record(ptype, [d for d in dates if format_date(d) in unsolved])
+    return solved
+
+
+def missing_stats(users, drange, stat_kinds, puzzle_types, budget, reserved=0):
+    """Work items for every user's newly solved puzzles, within what the
+    budget has left after the reserved requests already queued. No more
+    dates are looked up than there are requests left for, counting each as
+    a stats request (until the lookup, it isn't known which are solved).
+    The lookups all share one pool of general.threads threads, taking turns
+    (see api.get_puzzle_infos).
+    """
+    import api
+
+    lookups = []  # (user, dates, puzzle type)
+    requests, _ = budget.used()
+    for ptype in puzzle_types:
+        for user in users:
+            left = budget.left(requests + reserved)
+            dates = dates_to_check(user, drange, stat_kinds, ptype, left)
+            reserved += len(dates)
+            lookups.append((user, dates, ptype))
+
+    pinfos = api.get_puzzle_infos(
+        [(user.nyt, dates, ptype) for (user, dates, ptype) in lookups],
+        users[0].nyt.threads,
+    )
+    work = []
+    for (user, dates, ptype), pinfo in zip(lookups, pinfos):
+        solved = get_solved(user, dates, ptype, pinfo)
+        work.append([(Data.STATS, ptype, user, pi) for pi in solved])
+    for user in users:
+        user.unsolved.save()
+    return work
+
+
+def open_indexes(args):
+    """The indexes the args ask to keep up to date with new puzzles."""
+    indexes = []
+    if args.index:
+        from clueindex import ClueIndex
+
+        indexes.append(ClueIndex(args.data_dir))
+    if args.grids:
+        from grids import GridStore
+
+        indexes.append(GridStore(args.data_dir))
+    return indexes
+
+
+def date_of(w):
+    """The date of work item w, (kind, puzzle type, user, date or pinfo)."""
+    kind, _, _, x = w
+    return x if kind == Data.PUZZLE else parse_date_string(x["print_date"])
+
+
+def url_of(nyt, w):
+    kind, ptype, user, x = w
+    if kind == Data.PUZZLE:
+        return nyt.get_puzzle_url(x, ptype)
+    return user.nyt.get_stats_url(x)
+
+
+def store_work(database, indexes, stat_kinds, batch):
+    """Stores a batch of (work item, response): puzzles in database (and
+    indexes), stats in their user's DB.
+    """
+    groups = {}
+    for (kind, ptype, user, x), response in batch:
+        data = response if kind == Data.PUZZLE else response | x
+        groups.setdefault((kind, ptype, user), []).append(data)
+    for (kind, ptype, user), data in groups.items():
+        if kind == Data.PUZZLE:
+            database.store(data, Data.PUZZLE, ptype)
+            for index in indexes:
+                with METRICS.phase("%s.add" % type(index).__name__):
+                    index.add(ptype, data)
+        else:
+            user.database.store(data, stat_kinds, ptype)
+
+
+def sync_all(args, users, drange, stat_kinds, puzzle_types):
+    """One sync of everything the args ask for over drange: every missing
+    puzzle and stat in one stream, in the order general.order asks for, for
+    as long as the budget lasts.
+    """
+    import scheduler
+    from journal import Journal
+
+    journal = Journal(args.data_dir)
+    pending = journal.count(Journal.PENDING)
+    if pending:
+        print("Resuming a previous run with %d pending requests" % pending)
+
+    nyt, database = users[0].nyt, users[0].database
+    budget = scheduler.Budget.from_config(
+        args.data_dir, nyt.config["general"], args.max_requests
+    )
+    work = []
+    indexes = open_indexes(args) if args.puzzle else []
+    if args.puzzle:
+        with METRICS.phase("sync.scan.puzzles"):
+            work += missing_puzzles(database, drange, puzzle_types, indexes)
+    with METRICS.phase("sync.scan.stats"):
+        queued = sum(map(len, work))
+        work += missing_stats(users, drange, stat_kinds, puzzle_types, budget, queued)
+
+    # Round-robin first, so that on any one date users (who share the rate
+    # limit) take turns, as do puzzle types and kinds.
+    work = scheduler.order(interleave(*work), date_of, nyt.order)
+
+    to_url = lambda w: url_of(nyt, w)
+    to_session = lambda w: (w[2] or users[0]).nyt.session
+    # Stats urls are the same for every user.
+    key = lambda w: to_url(w) if w[2] is None else "%s %s" % (w[2].uid, to_url(w))
+    store = lambda batch: store_work(database, indexes, stat_kinds, batch)
+
+    with METRICS.phase("sync.fetch"):
+        try:
+            desc = "Getting puzzles and stats"
+            sync(nyt, journal, work, to_url, store, desc, to_session, key, budget)
+        finally:
+            budget.save()
+    print(budget.summary())
+
+    failed = journal.count(Journal.FAILED)
+    if failed:
+        print("%d requests failed; see %s" % (failed, journal.path))
+    journal.close()
+
+
+def write_metrics(args):
+    METRICS.write_json(args.metrics or os.path.join(args.data_dir, "metrics.json"))
+    if args.prometheus:
+        METRICS.write_prometheus(args.prometheus)
+
+
+def open_db(args, uid, puzzles, stat_kinds, puzzle_types, readonly=False):
+    """The user's DB, read from args.begin, and their unsolved cache."""
+    from negcache import UnsolvedCache
+
+    indent = None if args.compact_json else 4
+    database = DB(
+        args.data_dir,
+        puzzle_types,
+        stat_kinds,
+        puzzles,
+        uid,
+        args.storage,
+        indent,
+        readonly,
+    )
+    database.read(args.begin)
+    if args.rescan:
+        database.rescan()
+    unsolved = UnsolvedCache(os.path.join(args.data_dir, uid, "unsolved.json"))
+    return database, unsolved
+
+
+def status(args, stat_kinds, puzzle_types):
+    """Prints what's missing and what a sync would request, offline. Nothing
+    is saved.
+    """
+    import yaml
+
+    with open(args.config) as f:
+        size = yaml.safe_load(f)["info"]["max-chunk-size"]
+
+    drange = date_range(args.begin, datetime.today())
+    puzzles = args.puzzle  # shared, so counted with the first user only
+    for cookie_file in args.nyts_cookie:
+        uid = cookie.cached_user_id(args.data_dir, cookie_file, max_age=None)
+        if uid is None:
+            print("%s: no cached user id; run a sync first" % cookie_file)
+            continue
+
+        print("%s (%s)" % (uid, cookie_file))
+        database, unsolved = open_db(
+            args, uid, puzzles, stat_kinds, puzzle_types, readonly=True
+        )
+        for ptype in puzzle_types:
+            if puzzles:
+                n = len(database.missing_days(drange, Data.PUZZLE, ptype))
+                print("  %s %s: %d missing" % (ptype, Data.PUZZLE, n))
+
+            missing = set()
+            for stat in stat_kinds:
+                days = database.missing_days(drange, stat, ptype)
+                print("  %s %s: %d missing" % (ptype, stat, len(days)))
+                missing.update(days)
+
+            dates = unsolved.stale(ptype, sorted(missing))
+            chunks = plan_chunks(dates, size)
+            print(
+                "  %s plan: %d dates to check in %d info requests, "
+                "then up to %d stats requests"
+                % (ptype, len(dates), len(chunks), len(dates))
+            )
+        puzzles = False
 
 
 def main():
     args = validate_args(A)
-    nyt = api.Api(args.config, args.nyts_cookie)
 
     has_arg = lambda k: args.__dict__.get(k, False)
     stat_kinds = [k for k in Data.stat_kinds() if has_arg(k)]
     puzzle_types = [k for k in Puzzle.types() if has_arg(k)]
 
-    uid = nyt.user_id
-    database = DB(args.data_dir, puzzle_types, stat_kinds, args.puzzle, uid)
-    database.read(args.begin)
+    if args.status:
+        status(args, stat_kinds, puzzle_types)
+        return
+
+    import api
+    import transport
+
+    cache = None  # shared by every user, like the limiter
+    if args.cache:
+        import httpcache
+
+        directory = os.path.join(args.data_dir, "http-cache")
+        cache = httpcache.from_config(directory, api.get_config(args.config))
+
+    users = []
+    limiter = None
+    for cookie_file in args.nyts_cookie:
+        uid = cookie.cached_user_id(args.data_dir, cookie_file)
+        with METRICS.phase("user_id"):
+            nyt = api.Api(args.config, cookie_file, limiter, uid, cache)
+        limiter = nyt.limiter
+        if uid is None:
+            cookie.save_user_id(args.data_dir, cookie_file, nyt.user_id)
+        # Only the first user's DB holds the puzzles, which everyone shares.
+        puzzles = args.puzzle and not users
+        database, unsolved = open_db(
+            args, nyt.user_id, puzzles, stat_kinds, puzzle_types
+        )
+        users.append(User(nyt, database, unsolved))
 
     drange = date_range(args.begin, datetime.today())
-    if args.puzzle:
-        for ptype in puzzle_types:
-            missing = database.missing_days(drange, Data.PUZZLE, ptype)
-            urls = [nyt.get_puzzle_url(dt, ptype) for dt in missing]
-            puzzles = get(nyt, urls, "Getting %s puzzles" % (ptype))
-            database.store(puzzles, Data.PUZZLE, ptype)
+    sync_all(args, users, drange, stat_kinds, puzzle_types)
+    if args.compact:
+        with METRICS.phase("compact"):
+            for user in users:
+                user.database.compact()
+    print(limiter.summary())
+    print(transport.summary())
+    write_metrics(args)
 
-    for ptype in puzzle_types:
-        missing = set()
-        for stat in stat_kinds:
-            missing.update(database.missing_days(drange, stat, ptype))
-        dates = sorted(missing)
-
-        # Get puzzle info for missing dates
-        pinfo = nyt.get_puzzle_info(dates, ptype)
-        solved = [p  for p in pinfo if p["solved"]]
-        urls = [nyt.get_stats_url(p) for p in solved]
-
-        # Get stats for new solved puzzles
-        stats = get(nyt, urls, "Getting %s stats" % ptype)
-        assert len(solved) == len(stats), "misaligned puzzle info and stats"
-        data = [(stat | pi) for (stat, pi) in zip(stats, solved)]
-
-        database.store(data, stat_kinds, ptype)
+    if args.daemon:
+        from daemon import Releases, run
+
+        config = users[0].nyt.config
+
+        def sync(drange):
+            sync_all(args, users, drange, stat_kinds, puzzle_types)
+            write_metrics(args)
+
+        releases = Releases(config["puzzle"].get("release", {}))
+        run(sync, releases, config["general"], args.begin)
 
 
 if __name__ == "__main__":
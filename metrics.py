@@ -0,0 +1,243 @@
+import bisect
+import functools
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# Upper bounds (seconds) of the latency histogram buckets; the last bucket
+# is everything slower. These are Prometheus' defaults.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def endpoint(url):
+    """A url's path with its ids and dates taken out, so that every request
+    to one endpoint gets the same label:
+        /svc/crosswords/v6/puzzle/mini/2023-11-02.json
+            -> /svc/crosswords/v6/puzzle/mini/{}.json
+    """
+    return re.sub(r"(?<=/)[\d-]+(?=[/.]|$)", "{}", urlparse(url).path)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.n = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.n += 1
+
+    def percentile(self, p):
+        """Estimated by interpolating within the bucket it falls in."""
+        if not self.n:
+            return 0.0
+        rank = p / 100 * self.n
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lo = BUCKETS[i - 1] if i else 0.0
+                hi = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+                return lo + (hi - lo) * (rank - seen) / count
+            seen += count
+        return BUCKETS[-1]
+
+
+class Metrics:
+    """Timings and counts for one run: how long each phase took, per-endpoint
+    latency, statuses and bytes, and anything else worth counting (retries,
+    seconds spent waiting on the rate limiter). Safe to share between threads.
+
+    Phases nest (db.store includes datadir.write, say), so their times
+    don't add up to the run's.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.phases = {}  # {name: [seconds, calls]}
+        self.counters = {}  # {name: value}
+        self.latency = {}  # {endpoint: Histogram}
+        self.statuses = {}  # {endpoint: {status: count}}
+        self.bytes = {}  # {endpoint: bytes}
+        self.wire = {}  # {endpoint: bytes received, before decompression}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                totals = self.phases.setdefault(name, [0.0, 0])
+                totals[0] += elapsed
+                totals[1] += 1
+
+    def timed(self, name):
+        """Decorator: times every call of a function as phase `name`."""
+
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    return f(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, url, seconds, status, size, wire=None):
+        """One response (status None: the request errored) of size bytes,
+        which took wire bytes on the wire (default: size).
+        """
+        name = endpoint(url)
+        with self.lock:
+            self.latency.setdefault(name, Histogram()).observe(seconds)
+            statuses = self.statuses.setdefault(name, {})
+            statuses[status] = statuses.get(status, 0) + 1
+            self.bytes[name] = self.bytes.get(name, 0) + size
+            wire = size if wire is None else wire
+            self.wire[name] = self.wire.get(name, 0) + wire
+
+    def totals(self):
+        """(requests, bytes) received so far, over every endpoint."""
+        with self.lock:
+            requests = sum(sum(s.values()) for s in self.statuses.values())
+            return requests, sum(self.bytes.values())
+
+    def get(self, session, url, **kwargs):
+        """session.get(url, **kwargs), observed."""
+        start = time.perf_counter()
+        try:
+            response = session.get(url, **kwargs)
+        except OSError:
+            self.observe(url, time.perf_counter() - start, None, 0)
+            raise
+        size = len(response.content)
+        elapsed = time.perf_counter() - start
+        self.observe(url, elapsed, response.status_code, size, wire_bytes(response))
+        return response
+
+    def report(self):
+        with self.lock:
+            endpoints = {}
+            for name, h in self.latency.items():
+                endpoints[name] = {
+                    "requests": h.n,
+                    "bytes": self.bytes[name],
+                    "wire_bytes": self.wire[name],
+                    "statuses": {
+                        str(k or "error"): v for k, v in self.statuses[name].items()
+                    },
+                    "mean_s": h.sum / h.n,
+                    "p50_s": h.percentile(50),
+                    "p90_s": h.percentile(90),
+                    "p99_s": h.percentile(99),
+                    "buckets": dict(zip(map(str, BUCKETS + ("inf",)), h.counts)),
+                }
+            return {
+                "started": self.started,
+                "seconds": time.time() - self.started,
+                "phases": {
+                    k: {"seconds": s, "calls": n} for k, (s, n) in self.phases.items()
+                },
+                "counters": dict(self.counters),
+                "endpoints": endpoints,
+            }
+
+    def write_json(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.report(), f, indent=4)
+
+    def write_prometheus(self, filename):
+        """In the text format node_exporter's textfile collector reads."""
+        with open(filename, "w") as f:
+            f.write(prometheus(self.report()))
+
+
+def wire_bytes(response):
+    """What a requests.Response took on the wire (compressed, say): urllib3
+    counts what it read off the socket. None if that's not known.
+    """
+    try:
+        return response.raw.tell()
+    except (AttributeError, OSError):
+        return None
+
+
+def prometheus(report):
+    lines = []
+    endpoints = sorted(report["endpoints"].items())
+    prometheus_counters(lines, report)
+    prometheus_histograms(lines, endpoints)
+    prometheus_endpoints(lines, endpoints)
+    return "\n".join(lines) + "\n"
+
+
+def add(lines, metric, value, **labels):
+    """Appends a sample of metric to lines, in Prometheus text format."""
+    quote = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"')
+    pairs = ",".join('%s="%s"' % (k, quote(v)) for k, v in labels.items())
+    lines.append("xwdata_%s%s %s" % (metric, "{%s}" % pairs if pairs else "", value))
+
+
+def kind(lines, metric, type_):
+    lines.append("# TYPE xwdata_%s %s" % (metric, type_))
+
+
+def prometheus_counters(lines, report):
+    """The run's length, time and calls per phase, and the counters."""
+    phases = sorted(report["phases"].items())
+    kind(lines, "run_seconds", "gauge")
+    add(lines, "run_seconds", report["seconds"])
+    kind(lines, "phase_seconds_total", "counter")
+    for name, p in phases:
+        add(lines, "phase_seconds_total", p["seconds"], phase=name)
+    kind(lines, "phase_calls_total", "counter")
+    for name, p in phases:
+        add(lines, "phase_calls_total", p["calls"], phase=name)
+    for name, value in sorted(report["counters"].items()):
+        metric = "%s_total" % re.sub(r"\W", "_", name)
+        kind(lines, metric, "counter")
+        add(lines, metric, value)
+
+
+def prometheus_histograms(lines, endpoints):
+    """Request latency per endpoint."""
+    kind(lines, "request_seconds", "histogram")
+    for name, e in endpoints:
+        cumulative = 0
+        for le, count in e["buckets"].items():
+            cumulative += count
+            le = "+Inf" if le == "inf" else le
+            add(lines, "request_seconds_bucket", cumulative, endpoint=name, le=le)
+        add(lines, "request_seconds_sum", e["mean_s"] * e["requests"], endpoint=name)
+        add(lines, "request_seconds_count", e["requests"], endpoint=name)
+
+
+def prometheus_endpoints(lines, endpoints):
+    """Responses by status, and bytes, per endpoint."""
+    kind(lines, "responses_total", "counter")
+    for name, e in endpoints:
+        for status, n in sorted(e["statuses"].items()):
+            add(lines, "responses_total", n, endpoint=name, status=status)
+    for metric, key in [
+        ("response_bytes_total", "bytes"),
+        ("response_wire_bytes_total", "wire_bytes"),
+    ]:
+        kind(lines, metric, "counter")
+        for name, e in endpoints:
+            add(lines, metric, e[key], endpoint=name)
+
+
+# The one instance every module records into.
+METRICS = Metrics()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+from datetime import datetime
+
+from db import DB, Data, Puzzle, Storage
+from utils import chunker
+
+"""
+Imports a data dir in the files layout (see README.md) into the sqlite
+storage used by `main.py --storage sqlite`. Safe to re-run: records are
+keyed by (user, puzzle_type, kind, date) and replaced.
+"""
+
+
+def user_ids(directory):
+    """The directories holding a user's stats (others, like puzzles/ and
+    grids/, are shared).
+    """
+    return [
+        d
+        for d in sorted(os.listdir(directory))
+        if any(os.path.isdir(os.path.join(directory, d, k)) for k in Data.stat_kinds())
+    ]
+
+
+def copy(src, dst):
+    """Copies one (kind, puzzle_type) store into its sqlite counterpart."""
+    if hasattr(src, "documents"):  # DataDir
+        n = 0
+        for docs in chunker(src.documents(), 500):
+            dst.write(docs)
+            n += len(docs)
+        return n
+
+    rows = list(src.columns.rows())  # StatsFile
+    dst.write_rows(rows)
+    return len(rows)
+
+
+def migrate(directory):
+    kinds = Data.stat_kinds()
+    types = Puzzle.types()
+    for i, uid in enumerate(user_ids(directory)):
+        puzzles = i == 0  # puzzles are shared, so copy them only once
+        src = DB(directory, types, kinds, puzzles, uid, Storage.FILES)
+        dst = DB(directory, types, kinds, puzzles, uid, Storage.SQLITE)
+        src.read(datetime.min)
+        for kind in src.dbs:
+            for ptype in src.dbs[kind]:
+                n = copy(src.dbs[kind][ptype], dst.dbs[kind][ptype])
+                print("%s %s %s: %d records" % (uid, kind, ptype, n))
+
+
+if __name__ == "__main__":
+    try:
+        directory = sys.argv[1]
+    except IndexError:
+        print("Usage: `python3 migrate.py DATA_DIR`")
+    else:
+        migrate(directory)
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import gzip
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+"""
+A local stand-in for the NYT endpoints in api-config.yaml, for benchmarks
+and trying things out without a real cookie:
+
+    python3 mockserver.py --port 8080 --write-config mock-config.yaml
+    python3 main.py DATA_DIR -c mock-config.yaml -n any-cookie.json
+
+Any NYT-S cookie is accepted; its value is the user id. Documents are
+generated (deterministically) from the date, type and user.
+"""
+
+HOSTS = ["https://samizdat-graphql.nytimes.com", "https://www.nytimes.com"]
+
+
+def seeded(*parts):
+    """A Random seeded by parts, so the same request gets the same answer."""
+    key = "/".join(str(p) for p in parts).encode()
+    return random.Random(hashlib.sha256(key).digest())
+
+
+def puzzle_id(puzzle_type, d):
+    return int(d.strftime("%Y%m%d")) * 10 + (puzzle_type == "mini")
+
+
+def make_puzzle(puzzle_type, d):
+    """A v6 puzzle document: a symmetric grid of random letters with a
+    clue for every across and down entry.
+    """
+    r = seeded("puzzle", puzzle_type, d)
+    n = 5 if puzzle_type == "mini" else (21 if d.weekday() == 6 else 15)
+    cells = make_cells(r, n)
+    clues = make_clues(r, cells, n)
+    label(cells, clues)
+
+    return {
+        "body": [
+            {
+                "cells": cells,
+                "clueLists": [
+                    {
+                        "name": name,
+                        "clues": [
+                            k for k, c in enumerate(clues) if c["direction"] == name
+                        ],
+                    }
+                    for name in ["Across", "Down"]
+                ],
+                "clues": clues,
+                "dimensions": {"height": n, "width": n},
+            }
+        ],
+        "constructors": [r.choice(CONSTRUCTORS)],
+        "editor": "Will Shortz",
+        "id": puzzle_id(puzzle_type, d),
+        "publicationDate": d.isoformat(),
+    }
+
+
+def make_cells(r, n):
+    """An n x n grid of random letters, with rotationally symmetric blocks
+    ({}) unless it's a mini.
+    """
+    blocks = set()
+    for _ in range(0 if n == 5 else n * n // 7):
+        i = r.randrange(n * n)
+        blocks.update([i, n * n - 1 - i])  # rotational symmetry
+    return [
+        {} if i in blocks else {"answer": r.choice("ABCDEFGHIKLMNOPRSTU")}
+        for i in range(n * n)
+    ]
+
+
+def entries(cells, n):
+    """(direction, [cell index]) for every across and down entry."""
+    for direction, step in [("Across", 1), ("Down", n)]:
+        for i, cell in enumerate(cells):
+            row, col = divmod(i, n)
+            starts = cell != {} and (
+                (col == 0 if step == 1 else row == 0) or cells[i - step] == {}
+            )
+            if not starts:
+                continue
+            run = [i]
+            while True:
+                j = run[-1] + step
+                if j >= n * n or (step == 1 and j % n == 0) or cells[j] == {}:
+                    break
+                run.append(j)
+            if len(run) >= 2:
+                yield direction, run
+
+
+def make_clues(r, cells, n):
+    clues = []
+    for direction, run in entries(cells, n):
+        words = " ".join(r.choice(WORDS) for _ in range(r.randint(1, 4)))
+        clues.append(
+            {
+                "cells": run,
+                "direction": direction,
+                "label": "",
+                "text": [{"plain": words.capitalize()}],
+            }
+        )
+    return clues
+
+
+def label(cells, clues):
+    """Numbers the clues and the cells they start at, and points each cell
+    at its clues.
+    """
+    labels = {}
+    for clue in sorted(clues, key=lambda c: c["cells"][0]):
+        start = clue["cells"][0]
+        labels.setdefault(start, str(len(labels) + 1))
+        clue["label"] = labels[start]
+    for start, number in labels.items():
+        cells[start]["label"] = number
+    for k, clue in enumerate(clues):
+        for j in clue["cells"]:
+            cells[j].setdefault("clues", []).append(k)
+            cells[j]["type"] = 1
+
+
+def solved(user, puzzle_id, solve_rate):
+    return seeded("solved", user, puzzle_id).random() < solve_rate
+
+
+def make_game(user, puzzle_id):
+    r = seeded("game", user, puzzle_id)
+    opened = 1500000000 + puzzle_id % 100000000 // 10
+    secs = r.randint(30, 3600)
+    firsts = {"opened": opened, "solved": opened + secs}
+    if r.random() < 0.1:
+        firsts["checked"] = opened + secs // 2
+    return {
+        "calcs": {"percentFilled": 100, "secondsSpentSolving": secs, "solved": True},
+        "firsts": firsts,
+        "puzzleID": puzzle_id,
+        "userID": user,
+    }
+
+
+def make_info(user, puzzle_type, start, end, solve_rate):
+    results = []
+    d = start
+    while d <= end:
+        pid = puzzle_id(puzzle_type, d)
+        results.append(
+            {
+                "print_date": d.isoformat(),
+                "publish_type": puzzle_type.capitalize(),
+                "puzzle_id": pid,
+                "solved": solved(user, pid, solve_rate),
+            }
+        )
+        d += timedelta(1)
+    return {"status": "OK", "results": results}
+
+
+WORDS = (
+    "apple bird cargo delta ember fable gauge haven inlet joker kayak lemon "
+    "mango nomad ocean piano quilt raven sonar tango umbra vivid waltz xenon "
+    "yodel zebra"
+).split()
+CONSTRUCTORS = ["A. Setter", "B. Gridder", "C. Filler", "D. Cluer"]
+
+
+class Stats:
+    """What the server has seen: request counts and latencies by endpoint."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.latencies = {}  # {endpoint: [seconds]}
+            self.statuses = {}  # {status: count}
+            self.bytes = 0
+
+    def record(self, endpoint, status, seconds, size):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.bytes += size
+
+    def requests(self):
+        return sum(self.statuses.values())
+
+    def percentile(self, p):
+        with self.lock:
+            values = sorted(x for v in self.latencies.values() for x in v)
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+class MockServer(ThreadingHTTPServer):
+    """Serves the NYT endpoints. Every response is delayed by latency
+    (+/- jitter) seconds; error_rate of them are 503s; requests beyond
+    qps_limit per second are turned away with a 429 and a Retry-After.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(
+        self,
+        port=0,
+        latency=0.0,
+        jitter=0.0,
+        error_rate=0.0,
+        qps_limit=None,
+        solve_rate=0.8,
+    ):
+        super().__init__(("127.0.0.1", port), Handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.qps_limit = qps_limit
+        self.solve_rate = solve_rate
+        self.stats = Stats()
+        self.lock = threading.Lock()
+        self.recent = []  # request times in the last second
+        self.random = random.Random(0)
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server_address
+
+    def over_limit(self):
+        if not self.qps_limit:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            self.recent = [t for t in self.recent if t > now - 1]
+            if len(self.recent) >= self.qps_limit:
+                return True
+            self.recent.append(now)
+            return False
+
+    def start(self):
+        """Serves from a background thread; returns self."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def write_config(self, template, filename):
+        """Writes a copy of the api config template pointing at this server."""
+        with open(template) as f:
+            config = f.read()
+        for host in HOSTS:
+            config = config.replace(host, self.url)
+        with open(filename, "w") as f:
+            f.write(config)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    ROUTES = [
+        ("info", re.compile(r"/svc/crosswords/v3/(?P<user>[^/]+)/puzzles\.json")),
+        ("stats", re.compile(r"/svc/crosswords/v6/game/(?P<puzzle_id>\d+)\.json")),
+        (
+            "puzzle",
+            re.compile(
+                r"/svc/crosswords/v6/puzzle/(?P<type>\w+)/(?P<date>[\d-]+)\.json"
+            ),
+        ),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def user(self):
+        cookies = self.headers.get("Cookie", "")
+        match = re.search(r"NYT-S=([^;]+)", cookies)
+        return match.group(1) if match else None
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        user = self.user()
+        if user is None:
+            return self.respond("user", 403, {"errors": ["not logged in"]})
+        body = {"data": {"user": {"userInfo": {"regiId": user, "subscriptions": []}}}}
+        self.respond("user", 200, body)
+
+    def do_GET(self):
+        start = time.monotonic()
+        url = urlparse(self.path)
+        for endpoint, pattern in Handler.ROUTES:
+            match = pattern.fullmatch(url.path)
+            if match:
+                break
+        else:
+            return self.respond("unknown", 404, {"error": "not found"}, start)
+
+        server = self.server
+        if server.over_limit():
+            return self.respond(endpoint, 429, {"error": "slow down"}, start, retry=1)
+        delay = server.latency + server.random.uniform(-1, 1) * server.jitter
+        time.sleep(max(0.0, delay))
+        if server.random.random() < server.error_rate:
+            return self.respond(endpoint, 503, {"error": "try again"}, start)
+        if self.user() is None:
+            return self.respond(endpoint, 403, {"error": "not logged in"}, start)
+
+        args = match.groupdict()
+        if endpoint == "info":
+            q = {k: v[0] for k, v in parse_qs(url.query).items()}
+            start_date = date.fromisoformat(q["date_start"])
+            end_date = date.fromisoformat(q["date_end"])
+            body = make_info(
+                args["user"], q["publish_type"], start_date, end_date, server.solve_rate
+            )
+        elif endpoint == "stats":
+            body = make_game(self.user(), int(args["puzzle_id"]))
+        else:
+            d = datetime.strptime(args["date"], "%Y-%m-%d").date()
+            if d > date.today() + timedelta(1):
+                return self.respond(endpoint, 404, {"error": "not yet"}, start)
+            body = make_puzzle(args["type"], d)
+        self.respond(endpoint, 200, body, start)
+
+    def respond(self, endpoint, status, body, start=None, retry=None):
+        data = json.dumps(body).encode()
+        etag = '"%s"' % hashlib.sha256(data).hexdigest()[:32]
+        if status == 200 and self.headers.get("If-None-Match") == etag:
+            status, data = 304, b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if status in (200, 304):
+            self.send_header("ETag", etag)
+        if retry is not None:
+            self.send_header("Retry-After", str(retry))
+        if data and "gzip" in self.headers.get("Accept-Encoding", ""):
+            data = gzip.compress(data, compresslevel=5)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        seconds = time.monotonic() - start if start else 0.0
+        self.server.stats.record(endpoint, status, seconds, len(data))
+
+
+A = ArgumentParser(
+    description="Serves a stand-in for the NYT crossword api.",
+    formatter_class=ArgumentDefaultsHelpFormatter,
+)
+A.add_argument("--port", type=int, default=8080)
+A.add_argument("--latency", type=float, default=0.0, help="Seconds per response")
+A.add_argument("--jitter", type=float, default=0.0, help="+/- seconds of latency")
+A.add_argument("--error-rate", type=float, default=0.0, help="Fraction of 503s")
+A.add_argument("--qps-limit", type=int, default=None, help="429 beyond this rate")
+A.add_argument("--solve-rate", type=float, default=0.8, help="Fraction solved")
+A.add_argument(
+    "--write-config",
+    metavar="FILENAME",
+    help="Write a copy of api-config.yaml pointing at this server",
+)
+
+
+if __name__ == "__main__":
+    args = A.parse_args()
+    server = MockServer(
+        args.port,
+        args.latency,
+        args.jitter,
+        args.error_rate,
+        args.qps_limit,
+        args.solve_rate,
+    )
+    if args.write_config:
+        server.write_config("api-config.yaml", args.write_config)
+    print("Serving on %s" % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,61 @@
+import json
+import os
+import time
+from datetime import datetime
+
+from utils import atomic_write, format_date
+
+DAY = 24 * 60 * 60
+
+# (puzzles up to this many days old, are re-checked after this many seconds)
+TIERS = [
+    (2, 0),  # today's and yesterday's: every run
+    (30, DAY),
+    (365, 7 * DAY),
+    (None, 30 * DAY),
+]
+
+
+def ttl(age_days):
+    for max_age, seconds in TIERS:
+        if max_age is None or age_days <= max_age:
+            return seconds
+
+
+class UnsolvedCache:
+    """Remembers when each date's puzzle was last found unsolved, so that it
+    isn't asked about again until its TTL, which grows with the puzzle's age,
+    runs out. Stored as {puzzle_type: {YYYY-MM-DD: unix time checked}}.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            with open(filename) as f:
+                self.checked = json.load(f)
+        except FileNotFoundError:
+            self.checked = {}
+
+    def stale(self, puzzle_type, dates, now=None):
+        """The dates that are due to be checked again."""
+        now = now or time.time()
+        today = datetime.fromtimestamp(now)
+        checked = self.checked.get(puzzle_type, {})
+
+        def due(d):
+            at = checked.get(format_date(d))
+            return at is None or now - at >= ttl((today - d).days)
+
+        return [d for d in dates if due(d)]
+
+    def record(self, puzzle_type, dates, now=None):
+        """Notes that dates were checked and found unsolved."""
+        now = int(now or time.time())
+        checked = self.checked.setdefault(puzzle_type, {})
+        for d in dates:
+            checked[format_date(d)] = now
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with atomic_write(self.filename) as f:
+            json.dump(self.checked, f, indent=4, sort_keys=True)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import pathlib
+import sys
+import zlib
+from datetime import datetime
+
+from datadir import DataDir
+from metrics import METRICS
+from utils import atomic_write, chunker
+
+"""
+Packed archive for DataDir documents. Convert a data dir with
+`python3 packdir.py pack DATA_DIR` (or back with `unpack`); the source
+files are left in place, and can be deleted once you're happy.
+"""
+
+
+class PackDir(DataDir):
+    """Same interface as DataDir, but each month's documents are compressed
+    into one YYYY/MM/{basename}.pack, with a small {basename}.idx mapping
+    day to (offset, length). Documents are compressed against a dictionary
+    shared by the whole directory, since they repeat each other so much.
+    """
+
+    DICTIONARY_SIZE = 32 * 1024  # the most zlib will use
+
+    def __init__(self, directory, basename, indent=4, readonly=False):
+        # Packs ignore indent.
+        super().__init__(directory, basename, indent, readonly)
+        self.zdict = None
+
+    def month_path(self, dt, ext):
+        month = "%02d" % dt.month
+        return self.directory.joinpath(str(dt.year), month, self.basename + ext)
+
+    def dictionary(self, data=()):
+        """Loads the shared dictionary, building it from data if there's none
+        yet. It must never change afterwards: every pack depends on it. With
+        neither, it's empty, and left to be built from the first data written.
+        """
+        if self.zdict is None:
+            path = self.directory.joinpath(self.basename + ".zdict")
+            try:
+                self.zdict = path.read_bytes()
+            except FileNotFoundError:
+                # zlib looks for matches nearest the end, so that's where
+                # the samples go.
+                samples = b"".join(encode(d) for d in data[:16])
+                if not samples:
+                    return b""
+                self.zdict = samples[-PackDir.DICTIONARY_SIZE :]
+                path.write_bytes(self.zdict)
+        return self.zdict
+
+    def read(self, begin):
+        """Indexes documents on or after begin from the .idx files alone."""
+        index = {}
+        for idx in sorted(self.directory.glob("*/*/%s.idx" % self.basename)):
+            year, month = (int(p) for p in idx.relative_to(self.directory).parts[:2])
+            with open(idx) as f:
+                entries = json.load(f)
+            for day, (offset, length) in entries.items():
+                date = datetime(year, month, int(day))
+                if begin <= date:
+                    index[date] = (idx.with_suffix(".pack"), offset, length)
+        self.index = index
+        return index
+
+    @METRICS.timed("packdir.load")
+    def load(self, date):
+        pack, offset, length = self.index[date]
+        with open(pack, "rb") as f:
+            f.seek(offset)
+            body = f.read(length)
+        d = zlib.decompressobj(zdict=self.dictionary())
+        return json.loads(d.decompress(body) + d.flush())
+
+    @METRICS.timed("packdir.write")
+    def write(self, data):
+        zdict = self.dictionary(data)
+        months = {}
+        for d in data:
+            date = self._get_date(d)
+            months.setdefault((date.year, date.month), []).append((date, d))
+
+        for (year, month), docs in months.items():
+            pack = self.month_path(datetime(year, month, 1), ".pack")
+            idx = pack.with_suffix(".idx")
+            os.makedirs(pack.parent, exist_ok=True)
+            try:
+                with open(idx) as f:
+                    entries = json.load(f)
+            except FileNotFoundError:
+                entries = {}
+
+            # Append first, then point the index at it, so a crash never
+            # leaves the index referring to half a document. Replaced
+            # documents stay in the pack as garbage until it's rebuilt.
+            with open(pack, "ab") as f:
+                for date, d in docs:
+                    c = zlib.compressobj(level=9, zdict=zdict)
+                    body = c.compress(encode(d)) + c.flush()
+                    offset = f.tell()
+                    f.write(body)
+                    entries["%02d" % date.day] = [offset, len(body)]
+                    self.index[date] = (pack, offset, len(body))
+
+            write_idx(idx, entries)
+
+    def remove(self, dates):
+        """Drops dates from their months' indexes; the documents stay in the
+        packs as garbage, like replaced ones.
+        """
+        for date in dates:
+            pack, _, _ = self.index.pop(date)
+            idx = pack.with_suffix(".idx")
+            with open(idx) as f:
+                entries = json.load(f)
+            entries.pop("%02d" % date.day, None)
+            write_idx(idx, entries)
+
+
+def write_idx(idx, entries):
+    with atomic_write(idx) as f:
+        json.dump(entries, f, sort_keys=True)
+
+
+def encode(d):
+    return json.dumps(d, separators=(",", ":")).encode()
+
+
+def roots(directory):
+    """(path, basename) of every DataDir in a data dir (see README.md)."""
+    directory = pathlib.Path(directory)
+    for path in sorted(directory.glob("puzzles/*")):
+        yield path, "puzzle"
+    for path in sorted(directory.glob("*/full_stats/*")):
+        yield path, "stats"
+
+
+def convert(directory, to_pack=True):
+    for path, basename in roots(directory):
+        tree, pack = DataDir(path, basename), PackDir(path, basename)
+        src, dst = (tree, pack) if to_pack else (pack, tree)
+        src.read(datetime.min)
+        for docs in chunker(src.documents(), 500):
+            dst.write(docs)
+        print("%s: %d documents" % (path, len(src.index)))
+
+
+if __name__ == "__main__":
+    try:
+        command, directory = sys.argv[1:3]
+        if command not in ("pack", "unpack"):
+            raise ValueError(command)
+    except ValueError:
+        print("Usage: `python3 packdir.py pack|unpack DATA_DIR`")
+    else:
+        convert(directory, to_pack=command == "pack")
@@ -0,0 +1,120 @@
+import asyncio
+import threading
+import time
+
+from metrics import METRICS
+
+
+class TokenBucket:
+    """Hands out request slots at `rate` per second, with bursts of up to
+    `capacity`. Safe to share between threads and coroutines.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Takes a slot and returns how many seconds to wait before using it.
+        Tokens may go negative: each caller queues up behind the ones before it.
+        """
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.updated
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def wait(self):
+        delay = self.reserve()
+        METRICS.count("limiter_wait_seconds", delay)
+        time.sleep(delay)
+
+    async def wait_async(self):
+        delay = self.reserve()
+        METRICS.count("limiter_wait_seconds", delay)
+        await asyncio.sleep(delay)
+
+    def send(self, request):
+        """Waits for a slot, then calls request() (which returns a
+        requests.Response), recording how it went.
+        """
+        self.wait()
+        start = time.monotonic()
+        try:
+            response = request()
+        except OSError:
+            self.record(None, None)
+            raise
+        self.record(response.status_code, time.monotonic() - start)
+        return response
+
+    def record(self, status, latency):
+        """Observe one response; a fixed rate has no use for it."""
+        pass
+
+    def summary(self):
+        return "Rate fixed at %.1f qps" % self.rate
+
+
+class AdaptiveRate(TokenBucket):
+    """A TokenBucket whose rate follows the server (AIMD): it grows by about
+    `step` qps per second while responses are healthy, and is cut by
+    `decrease` on a 429, a 5xx, a connection error or rising latency.
+    """
+
+    def __init__(self, rate, min_rate=1, max_rate=50, step=1, decrease=0.5):
+        super().__init__(rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.step = step
+        self.decrease = decrease
+        self.latency = None  # moving average
+        self.baseline = None  # lowest moving average seen
+        self.cut = 0  # time of the last decrease
+        self.backoffs = 0
+        self.low, self.high = rate, rate
+
+    def record(self, status, latency):
+        """Observe one response; status is None if the request errored."""
+        with self.lock:
+            if latency is not None:
+                self.update_latency(latency)
+            slow = self.latency > 2 * self.baseline if self.baseline else False
+            if status is None or status == 429 or status >= 500 or slow:
+                self.back_off()
+            else:
+                self.set_rate(self.rate + self.step / self.rate)
+
+    def update_latency(self, latency):
+        avg = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+        self.latency = avg
+        self.baseline = avg if self.baseline is None else min(self.baseline, avg)
+
+    def back_off(self):
+        # Requests already in flight report the same congestion; one cut
+        # per second keeps them from collapsing the rate.
+        now = time.monotonic()
+        if now - self.cut < 1:
+            return
+        self.cut = now
+        self.backoffs += 1
+        self.set_rate(self.rate * self.decrease)
+        self.baseline = self.latency  # what counts as slow has moved
+
+    def set_rate(self, rate):
+        self.rate = min(self.max_rate, max(self.min_rate, rate))
+        self.capacity = max(1, self.rate)
+        self.low, self.high = min(self.low, self.rate), max(self.high, self.rate)
+
+    def summary(self):
+        return "Rate converged on %.1f qps (range %.1f-%.1f, %d backoffs)" % (
+            self.rate,
+            self.low,
+            self.high,
+            self.backoffs,
+        )
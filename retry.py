@@ -0,0 +1,91 @@
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from metrics import METRICS
+
+
+class FetchError(Exception):
+    """A request that still failed after every retry it was allowed."""
+
+    def __init__(self, url, reason):
+        super().__init__("%s: %s" % (url, reason))
+        self.url = url
+        self.reason = reason
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, honoring Retry-After."""
+
+    RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+    def __init__(self, attempts=5, backoff=1.0, backoff_max=60.0):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+
+    def retryable(self, status):
+        return status in self.RETRY_STATUSES
+
+    def delay(self, attempt, headers=None):
+        """Seconds to wait before retry number `attempt` (counting from 0)."""
+        retry_after = parse_retry_after((headers or {}).get("Retry-After"))
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2**attempt))
+
+    @staticmethod
+    def outcome(get, *args):
+        """get(*args), or the FetchError it raised: for streams, which pass
+        failures on to their consumer rather than stopping at the first.
+        """
+        try:
+            return get(*args)
+        except FetchError as e:
+            return e
+
+    def failed(self, attempt, url, status=None, headers=None, error=None):
+        """Decides what follows a failed attempt (counting from 0): one that
+        got an HTTP status (with its headers), or that raised error. Returns
+        the seconds to wait before trying again, or raises FetchError once
+        retries run out, or straight away for statuses that retrying won't
+        fix (eg 403, 404).
+        """
+        last = attempt == self.attempts - 1
+        if last or (error is None and not self.retryable(status)):
+            METRICS.count("fetch_errors")
+            reason = error if error is not None else "HTTP %s" % status
+            raise FetchError(url, reason) from error
+        METRICS.count("retries")
+        return self.delay(attempt, headers)
+
+    def call(self, send, url=""):
+        """Calls send() until it returns an ok requests.Response, sleeping
+        between attempts as failed decides.
+        """
+        for attempt in range(self.attempts):
+            try:
+                response = send()
+            except OSError as e:  # requests.RequestException is an OSError
+                time.sleep(self.failed(attempt, url, error=e))
+                continue
+            if response.ok:
+                return response
+            status, headers = response.status_code, response.headers
+            time.sleep(self.failed(attempt, url or response.url, status, headers))
+
+
+def parse_retry_after(value):
+    """Retry-After is either a number of seconds or an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
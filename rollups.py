@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+import json
+import math
+import sys
+from datetime import date, datetime
+
+from utils import atomic_write
+
+"""
+Aggregates of a stats csv's solved puzzles, kept next to it (daily.csv ->
+daily.rollup.json) by StatsFile as rows are written, so that dashboards can
+read a small summary instead of the whole history:
+
+    python3 rollups.py DATA_DIR/{userid}/stats/daily.csv
+"""
+
+# Solve times go in log-spaced buckets: every time in bucket k is within
+# GAMMA**(k-1), GAMMA**k, so percentiles read off them are within ~2.5%.
+# Sketches for different groups (months, say) merge by adding counts.
+GAMMA = 1.05
+
+
+def bucket(secs):
+    return math.ceil(math.log(secs, GAMMA))
+
+
+def bucket_value(k):
+    """The midpoint of bucket k, relative error-wise."""
+    return 2 * GAMMA**k / (GAMMA + 1)
+
+
+def empty():
+    return {"count": 0, "sum": 0, "min": None, "max": None, "cheated": 0, "sketch": {}}
+
+
+def add(group, secs, cheated):
+    group["count"] += 1
+    group["sum"] += secs
+    group["min"] = secs if group["min"] is None else min(group["min"], secs)
+    group["max"] = secs if group["max"] is None else max(group["max"], secs)
+    group["cheated"] += int(bool(cheated))
+    k = str(bucket(secs))
+    group["sketch"][k] = group["sketch"].get(k, 0) + 1
+
+
+def merge(*groups):
+    """One group summing several, eg months into a year."""
+    total = empty()
+    for g in groups:
+        for k in ["count", "sum", "cheated"]:
+            total[k] += g[k]
+        for k, f in [("min", min), ("max", max)]:
+            values = [v for v in (total[k], g[k]) if v is not None]
+            total[k] = f(values) if values else None
+        for k, n in g["sketch"].items():
+            total["sketch"][k] = total["sketch"].get(k, 0) + n
+    return total
+
+
+def percentile(group, p):
+    """Approximate p'th percentile solve time (None for an empty group)."""
+    rank = p / 100 * group["count"]
+    seen = 0
+    for k in sorted(group["sketch"], key=int):
+        seen += group["sketch"][k]
+        if seen >= rank:
+            return min(group["max"], max(group["min"], bucket_value(int(k))))
+    return group["max"]
+
+
+def summary(group):
+    n = group["count"]
+    return {
+        "count": n,
+        "mean": group["sum"] / n if n else None,
+        "min": group["min"],
+        "p50": percentile(group, 50) if n else None,
+        "p90": percentile(group, 90) if n else None,
+        "max": group["max"],
+        "cheated_ratio": group["cheated"] / n if n else None,
+    }
+
+
+class Rollups:
+    """Per-weekday, per-month and overall count/sum/min/max, cheat counts and
+    percentile sketches of solve times, plus streaks of consecutive solved
+    days. Each solved day is counted once, however often it's rewritten;
+    StatsFile rebuilds them when a counted day's time or cheating changes.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            with open(filename) as f:
+                self.data = json.load(f)
+        except FileNotFoundError:
+            self.data = Rollups.empty()
+
+    @staticmethod
+    def empty():
+        return {
+            "solved": 0,
+            "all": empty(),
+            "weekday": {},
+            "month": {},
+            "streak": {"current": 0, "longest": 0, "last": None},
+        }
+
+    @property
+    def solved(self):
+        return self.data["solved"]
+
+    def add(self, days, columns):
+        """Counts newly solved days, [(day ordinal, solve secs, cheated)];
+        columns (statsfile.Columns, already holding them) is only consulted
+        when days fill in history behind the current streak.
+        """
+        d = self.data
+        for day, secs, cheated in days:
+            dt = date.fromordinal(day)
+            groups = [
+                d["all"],
+                d["weekday"].setdefault(dt.strftime("%a"), empty()),
+                d["month"].setdefault(dt.strftime("%Y-%m"), empty()),
+            ]
+            for g in groups:
+                add(g, secs, cheated)
+            d["solved"] += 1
+
+        streak = d["streak"]
+        days = sorted(day for (day, _, _) in days)
+        if days and streak["last"] is not None and days[0] <= streak["last"]:
+            self.recount_streaks(columns)
+            return
+        for day in days:
+            extends = streak["last"] is not None and day == streak["last"] + 1
+            streak["current"] = streak["current"] + 1 if extends else 1
+            streak["longest"] = max(streak["longest"], streak["current"])
+            streak["last"] = day
+
+    def recount_streaks(self, columns):
+        first, solved = columns.solved_days()
+        current = longest = run = 0
+        last = None
+        for i, s in enumerate(solved):
+            run = run + 1 if s else 0
+            longest = max(longest, run)
+            if s:
+                current, last = run, first + i
+        self.data["streak"] = {"current": current, "longest": longest, "last": last}
+
+    def rebuild(self, columns):
+        """Recounts everything in columns from scratch."""
+        self.data = Rollups.empty()
+        solved = zip(columns.day, columns.solve_time_secs, columns.cheated)
+        self.add([s for s in solved if s[1] > 0], columns)
+
+    def save(self):
+        with atomic_write(self.filename) as f:
+            json.dump(self.data, f, sort_keys=True)
+
+
+def main(filename):
+    from statsfile import StatsFile
+
+    stats = StatsFile(filename)
+    stats.read(datetime.min)
+    d = stats.rollups.data
+
+    header = ("", "solved", "mean", "min", "p50", "p90", "max", "cheated")
+    print("%-6s%7s%8s%8s%8s%8s%8s%9s" % header)
+    weekdays = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+    groups = [(w, d["weekday"][w]) for w in weekdays if w in d["weekday"]]
+    for name, group in groups + [("all", d["all"])]:
+        s = summary(group)
+        if not s["count"]:
+            continue
+        s["name"], s["cheated_ratio"] = name, 100 * s["cheated_ratio"]
+        print(
+            "%(name)-6s%(count)7d%(mean)8.0f%(min)8d%(p50)8.0f%(p90)8.0f%(max)8d"
+            "%(cheated_ratio)8.0f%%" % s
+        )
+
+    streak = d["streak"]
+    last = date.fromordinal(streak["last"]).isoformat() if streak["last"] else "-"
+    print(
+        "Streak: %d (through %s), longest %d"
+        % (streak["current"], last, streak["longest"])
+    )
+
+
+if __name__ == "__main__":
+    try:
+        filename = sys.argv[1]
+    except IndexError:
+        print("Usage: `python3 rollups.py DATA_DIR/{userid}/stats/daily.csv`")
+    else:
+        main(filename)
@@ -0,0 +1,123 @@
+import json
+import math
+import os
+from datetime import date
+
+from metrics import METRICS
+from utils import atomic_write
+
+"""
+What a sync fetches first, and how much it may fetch. Work from every puzzle
+type and data kind goes into one queue, in date order (newest first unless
+general.order says 'oldest'), and is handed out until a Budget runs out.
+Whatever is left is still missing from the DB, so the next run picks it up
+where this one stopped.
+"""
+
+ORDERS = ["newest", "oldest"]
+
+
+def order(items, date_of, which="newest"):
+    """items by date_of(item), newest or oldest first. Items on the same date
+    keep their order, so puzzle types, kinds and users stay interleaved.
+    """
+    if which not in ORDERS:
+        raise ValueError("order must be one of %s, not %r" % (ORDERS, which))
+    return sorted(items, key=date_of, reverse=which == "newest")
+
+
+class Budget:
+    """Caps on the requests (retries and revalidations included; cache hits
+    aren't requests) a run may make, and on the requests and bytes over a
+    day; None for no cap. What today's earlier runs used is kept in
+    DATA_DIR/budget.json. Requests already in flight when the budget runs out
+    still complete, so it can be overshot by a few.
+    """
+
+    FILENAME = "budget.json"
+
+    def __init__(self, directory, run_requests=None, day_requests=None, day_bytes=None):
+        self.filename = os.path.join(directory, Budget.FILENAME)
+        self.run_requests = run_requests
+        self.day_requests = day_requests
+        self.day_bytes = day_bytes
+        self.today = date.today().isoformat()
+        try:
+            with open(self.filename) as f:
+                day = json.load(f)
+        except FileNotFoundError:
+            day = {}
+        if day.get("date") != self.today:
+            day = {"date": self.today, "requests": 0, "bytes": 0}
+        self.day = day
+        self.start = METRICS.totals()
+        self.leftover = 0
+
+    @staticmethod
+    def from_config(directory, config, run_requests=None):
+        """A Budget per the api config's general section; run_requests, if
+        given (0 included), overrides max-requests-per-run.
+        """
+        limit = lambda k: config.get(k) or None  # 0 in the config means no cap
+        mb = limit("max-mb-per-day")
+        if run_requests is None:
+            run_requests = limit("max-requests-per-run")
+        return Budget(
+            directory,
+            run_requests,
+            limit("max-requests-per-day"),
+            mb and mb * 1024 * 1024,
+        )
+
+    def used(self):
+        """(requests, bytes) this run."""
+        requests, size = METRICS.totals()
+        return requests - self.start[0], size - self.start[1]
+
+    def left(self, handed_out=0):
+        """Requests left, counting handed_out ones not made yet; inf if
+        there's no cap on requests. 0 once the byte cap is reached.
+        """
+        requests, size = self.used()
+        requests = max(requests, handed_out)
+        if self.day_bytes is not None and self.day["bytes"] + size >= self.day_bytes:
+            return 0
+        left = math.inf
+        if self.run_requests is not None:
+            left = min(left, self.run_requests - requests)
+        if self.day_requests is not None:
+            left = min(left, self.day_requests - self.day["requests"] - requests)
+        return max(left, 0)
+
+    def take(self, items):
+        """Yields items while the budget lasts, one request each. Counts the
+        rest as leftover.
+        """
+        items = list(items)
+        base, _ = self.used()
+        for i, item in enumerate(items):
+            if not self.left(base + i):
+                self.leftover += len(items) - i
+                return
+            yield item
+
+    def save(self):
+        """Adds this run's use to today's."""
+        requests, size = self.used()
+        day = dict(self.day)
+        day["requests"] += requests
+        day["bytes"] += size
+        with atomic_write(self.filename) as f:
+            json.dump(day, f, indent=4)
+
+    def summary(self):
+        requests, size = self.used()
+        s = "Budget: %d requests, %.1f MB this run" % (requests, size / 1024 / 1024)
+        if self.day_requests is not None or self.day_bytes is not None:
+            s += "; %d requests, %.1f MB today" % (
+                self.day["requests"] + requests,
+                (self.day["bytes"] + size) / 1024 / 1024,
+            )
+        if self.leftover:
+            s += ". Ran out with %d fetches to go, left for the next run" % self.leftover
+        return s
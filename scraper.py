@@ -1,30 +1,112 @@
-import collections
+import queue
 import threading
-import time
+
+from metrics import METRICS
+from ratelimit import TokenBucket
+from retry import FetchError, RetryPolicy
 
 
 class Scraper:
-    def __init__(self, session, threads=10, qps=5):
+    def __init__(
+        self, session, threads=10, qps=5, retry=None, limiter=None, cache=None
+    ):
+        """cache: an HttpCache to serve (and keep) responses, if any."""
         self.session = session
+        self.threads = threads
         self.semaphore = threading.Semaphore(threads)
         self.qps = qps
-        self.timestamps = collections.deque(maxlen=self.qps)
-
-    def wait_for_rate_limit(self):
-        while True:
-            now = time.monotonic()
-            while self.timestamps and self.timestamps[0] <= now - 1:
-                self.timestamps.popleft()
+        self.limiter = limiter or TokenBucket(qps)
+        self.retry = retry or RetryPolicy()
+        self.cache = cache
 
-            if len(self.timestamps) < self.qps:
-                break
-            time.sleep(0.05)
+    def request(self, url, session=None):
+        session = session or self.session
+        send = lambda headers: self.limiter.send(
+            lambda: METRICS.get(session, url, headers=headers)
+        )
+        if self.cache:
+            return self.cache.get(session, url, send)
+        return send({})
 
-    def get(self, url):
+    def get(self, url, session=None):
+        """Returns the json at url, raising FetchError if it can't be had.
+        session, if given, is used instead of the scraper's own.
+        """
         with self.semaphore:
-            self.wait_for_rate_limit()
+            response = self.retry.call(lambda: self.request(url, session), url)
+            try:
+                return response.json()
+            except ValueError as e:
+                raise FetchError(url, "invalid json") from e
+
+    def stream(self, items, to_url, maxsize, to_session=None):
+        """Fetches to_url(item) for every item on a pool of threads, yielding
+        (item, response) pairs in completion order; response is a FetchError
+        for items that failed. At most maxsize responses are held waiting for
+        the consumer; beyond that the workers block. to_session(item) picks
+        the session to use for an item, when they don't all share one.
+        """
+        to_session = to_session or (lambda item: self.session)
+        results = queue.Queue(maxsize)
+        todo = iter(items)
+        lock = threading.Lock()
+        stop = threading.Event()
+
+        def next_item():
+            with lock:
+                return next(todo, DONE)
+
+        def fetch(item):
+            return self.retry.outcome(self.get, to_url(item), to_session(item))
+
+        args = (next_item, fetch, results, stop)
+        workers = [
+            threading.Thread(target=work, args=args, daemon=True)
+            for _ in range(self.threads)
+        ]
+        for w in workers:
+            w.start()
+        yield from drain(results, workers, stop)
+
+
+DONE = object()  # what a worker puts on the queue when it's finished
+
+
+def work(next_item, fetch, results, stop):
+    """Puts (item, fetch(item)) on results for each next_item() until there
+    are none left (or stop is set), then (DONE, None); or (DONE, exception)
+    if something went wrong.
+    """
+    try:
+        while not stop.is_set():
+            item = next_item()
+            if item is DONE:
+                break
+            results.put((item, fetch(item)))
+    except Exception as e:
+        results.put((DONE, e))
+    results.put((DONE, None))
 
-            response = self.session.get(url)
 
-            self.timestamps.append(time.monotonic())
-            return response.json()
+def drain(results, workers, stop):
+    """Yields the workers' results until they're all DONE, raising any
+    exception one of them hit; then stops them.
+    """
+    try:
+        running = len(workers)
+        while running:
+            item, result = results.get()
+            if item is not DONE:
+                yield item, result
+            elif result is not None:
+                raise result
+            else:
+                running -= 1
+    finally:
+        # Unblock any workers waiting on a full queue so they can exit.
+        stop.set()
+        while any(w.is_alive() for w in workers):
+            try:
+                results.get(timeout=0.1)
+            except queue.Empty:
+                pass
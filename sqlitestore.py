@@ -0,0 +1,124 @@
+import json
+import os
+import sqlite3
+from urllib.parse import quote
+
+from statsfile import parse, to_record
+from utils import format_date, parse_date_string
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    user TEXT NOT NULL,  -- '' for puzzles, which every user shares
+    puzzle_type TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    date TEXT NOT NULL,  -- YYYY-MM-DD
+    complete INTEGER NOT NULL,  -- 0 for stats rows of unsolved puzzles
+    body TEXT NOT NULL,
+    PRIMARY KEY (user, puzzle_type, kind, date)
+) WITHOUT ROWID;
+"""
+
+
+def connect(filename, readonly=False):
+    """readonly opens filename without creating or changing anything: an
+    empty database stands in if there isn't one yet.
+    """
+    if readonly:
+        return connect_readonly(filename)
+    conn = sqlite3.connect(filename)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def connect_readonly(filename):
+    if not os.path.exists(filename):
+        conn = sqlite3.connect(":memory:")
+        conn.executescript(SCHEMA)
+        return conn
+    # A read-only connection to a WAL database creates the -wal and -shm
+    # files if they're missing. They're only missing while nothing has the
+    # database open, and then it can't change under us.
+    uri = "file:%s?mode=ro" % quote(os.path.abspath(filename))
+    if not os.path.exists(filename + "-wal"):
+        uri += "&immutable=1"
+    return sqlite3.connect(uri, uri=True)
+
+
+class SqliteStore:
+    """One (user, puzzle_type, kind) slice of the records table, with the
+    same interface as DataDir and StatsFile. With rows=True the slice holds
+    summary stats as csv rows (see statsfile) rather than json documents.
+    """
+
+    def __init__(self, conn, user, puzzle_type, kind, rows=False):
+        self.conn = conn
+        self.key = (user, puzzle_type, kind)
+        self.rows = rows
+        self.begin = ""
+
+    def read(self, begin):
+        """Nothing to load up front: queries go straight to the table."""
+        self.begin = format_date(begin)
+
+    def select(self, columns, where="", args=()):
+        sql = "SELECT %s FROM records WHERE user=? AND puzzle_type=? AND kind=? %s"
+        return self.conn.execute(sql % (columns, where), self.key + tuple(args))
+
+    def missing_days(self, dates):
+        if not dates:
+            return []
+        bounds = (format_date(min(dates)), format_date(max(dates)))
+        have = self.select("date", "AND complete AND date BETWEEN ? AND ?", bounds)
+        have = {parse_date_string(d) for (d,) in have}
+        return [d for d in dates if d not in have]
+
+    def load(self, date):
+        (body,) = self.select("body", "AND date=?", [format_date(date)]).fetchone()
+        return self.decode(body)
+
+    def dates(self):
+        rows = self.select("date", "AND date>=? ORDER BY date", [self.begin])
+        return [parse_date_string(d) for (d,) in rows]
+
+    def documents(self):
+        """Lazily yields the records on or after begin, in date order."""
+        bodies = self.select("body", "AND date>=? ORDER BY date", [self.begin])
+        for (body,) in bodies:
+            yield self.decode(body)
+
+    def decode(self, body):
+        d = json.loads(body)
+        return parse(d) if self.rows else d
+
+    def write(self, data):
+        if self.rows:
+            self.write_rows(map(to_record, data))
+            return
+
+        entries = []
+        for d in data:
+            date_str = d.get("print_date", d.get("publicationDate"))
+            entries.append((date_str, 1, json.dumps(d)))
+        self.put(entries)
+
+    def write_rows(self, rows):
+        """Stores csv-style stats rows, as made by statsfile.to_record."""
+        entries = []
+        for r in rows:
+            complete = 1 if r.get("solve_time_secs") else 0
+            entries.append((r["date"], complete, json.dumps(r)))
+        self.put(entries)
+
+    def put(self, entries):
+        """Inserts (date, complete, body) entries in one transaction."""
+        sql = "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?)"
+        with self.conn:
+            self.conn.executemany(sql, (self.key + e for e in entries))
+
+    def remove(self, dates):
+        """Deletes the records at dates, so that they count as missing."""
+        sql = "DELETE FROM records WHERE user=? AND puzzle_type=? AND kind=? AND date=?"
+        with self.conn:
+            self.conn.executemany(sql, (self.key + (format_date(d),) for d in dates))
@@ -1,30 +1,226 @@
-from datetime import datetime
+from array import array
+from bisect import bisect_left
+from datetime import date, datetime
 import csv
 import os
 import pathlib
 
-from utils import parse_date_string, format_date
+from metrics import METRICS
+from rollups import Rollups
+from utils import atomic_write, parse_date_string
 
 
 class StatsFile:
-    def __init__(self, filename):
+    """Summary stats as a csv file sorted by date, plus an append-only log of
+    rows written since. Reading merges the two (the log wins); the log is
+    folded back into the csv by compact, which write calls once it gets long.
+    In memory, records are held as Columns. Aggregates of the solved days
+    are kept alongside, in a Rollups file updated by each write (or, if
+    readonly, only in memory).
+    """
+
+    def __init__(self, filename, compact_after=1000, readonly=False):
         self.filename = pathlib.Path(filename)
-        os.makedirs(self.filename.parent, exist_ok=True)
-        self.data = None
+        self.log = self.filename.with_name(self.filename.name + ".log")
+        if not readonly:
+            os.makedirs(self.filename.parent, exist_ok=True)
+        self.compact_after = compact_after
+        self.readonly = readonly
+        self.columns = Columns()
+        self.logged = 0
+        self.rollups = Rollups(self.filename.with_suffix(".rollup.json"))
 
+    @METRICS.timed("statsfile.read")
     def read(self, begin):
-        self.data = read(self.filename)
-        return self.data
+        logged = read_rows(self.log, quiet=True)
+        # Until its first compaction, everything is in the log.
+        self.columns = read_columns(self.filename, quiet=bool(logged))
+        self.columns.update(Columns.from_rows(logged))
+        self.logged = len(logged)
+        # Missing, or written by an older version, or out of step some other way.
+        if self.rollups.solved != self.columns.count_solved():
+            self.rollups.rebuild(self.columns)
+            if not self.readonly:
+                self.rollups.save()
+        return self.columns
+
+    @property
+    def data(self):
+        """Parsed records, in date order."""
+        return [parse(r) for r in self.columns.rows()]
 
     def missing_days(self, dates):
-        return missing_days(self.data, dates)
+        first, solved = self.columns.solved_days()
+
+        def have(d):
+            i = d.toordinal() - first
+            return 0 <= i < len(solved) and solved[i]
 
+        return [d for d in dates if not have(d)]
+
+    @METRICS.timed("statsfile.write")
     def write(self, data):
-        store(self.filename, self.data, data)
+        """Appends data to the log; compacts if the log has grown too long."""
+        rows = [normalize(to_record(pi)) for pi in data]
+        append_rows(self.log, rows)
+        new = Columns.from_rows(rows)
+        before = [self.columns.solve(day) for day in new.day]
+        self.columns.update(new)
+        after = [self.columns.solve(day) for day in new.day]
+        changed = [b for b, a in zip(before, after) if b is not None and a != b]
+        fresh = [(day,) + a for day, b, a in zip(new.day, before, after) if not b and a]
+        if changed:
+            # Counted already, and now different: there's no taking a day out
+            # of min/max, so count everything again.
+            self.rollups.rebuild(self.columns)
+        elif fresh:
+            self.rollups.add(fresh, self.columns)
+        if changed or fresh:
+            self.rollups.save()
+        self.logged += len(rows)
+        if self.logged >= self.compact_after:
+            self.compact()
 
+    @METRICS.timed("statsfile.compact")
+    def compact(self):
+        """Rewrites the csv with everything in the log, then drops the log."""
+        if not self.logged and not self.log.exists():
+            return
+        write_rows(self.filename, self.columns.rows())
+        self.log.unlink(missing_ok=True)
+        self.logged = 0
 
-def read(filename):
-    """Reads records from csv file."""
+
+# Write data in the format @kesyog uses.
+FIELDNAMES = "date,puzzle_id,weekday,solve_time_secs,opened_unix,solved_unix,cheated"
+FIELDNAMES = FIELDNAMES.split(",")
+
+MISSING = -1  # stands in for blank cells in the int columns
+
+
+def ints(values, typecode):
+    return array(typecode, [int(s) if s else MISSING for s in values])
+
+
+class Columns:
+    """Stats records as typed arrays, one per csv field, sorted by day.
+    day holds date ordinals (the weekday column is derived from it), the
+    *_unix columns epoch seconds, and MISSING marks blanks.
+    """
+
+    TYPECODES = {
+        "day": "i",
+        "puzzle_id": "q",
+        "solve_time_secs": "i",
+        "opened_unix": "q",
+        "solved_unix": "q",
+        "cheated": "b",
+    }
+
+    def __init__(self, **columns):
+        for name, typecode in Columns.TYPECODES.items():
+            setattr(self, name, columns.get(name, array(typecode)))
+
+    def __len__(self):
+        return len(self.day)
+
+    @staticmethod
+    def from_strings(columns):
+        """Converts {field: sequence of csv cells} a whole column at a time."""
+        get = lambda k: columns.get(k, ())
+        to_day = lambda s: date.fromisoformat(s).toordinal()
+        return Columns(
+            day=array("i", map(to_day, get("date"))),
+            puzzle_id=ints(get("puzzle_id"), "q"),
+            solve_time_secs=ints(get("solve_time_secs"), "i"),
+            opened_unix=ints(get("opened_unix"), "q"),
+            solved_unix=ints(get("solved_unix"), "q"),
+            cheated=array("b", map("true".__eq__, get("cheated"))),
+        )
+
+    @staticmethod
+    def from_rows(rows):
+        """Columns from csv-style row dicts, which need not be in order.
+        The last row for a date wins.
+        """
+        rows = [r for (_, r) in sorted({r["date"]: r for r in rows}.items())]
+        return Columns.from_strings({k: [r[k] for r in rows] for k in FIELDNAMES})
+
+    def update(self, other):
+        """Merges other in; where both have a day, other wins."""
+        if not len(other):
+            return
+        if not len(self) or self.day[-1] < other.day[0]:  # the usual case
+            for name in Columns.TYPECODES:
+                getattr(self, name).extend(getattr(other, name))
+            return
+
+        for j, day in enumerate(other.day):
+            i = bisect_left(self.day, day)
+            exists = i < len(self) and self.day[i] == day
+            for name in Columns.TYPECODES:
+                column, value = getattr(self, name), getattr(other, name)[j]
+                if exists:
+                    column[i] = value
+                else:
+                    column.insert(i, value)
+
+    def solved_days(self):
+        """(first day, bitmap) where bitmap[day - first] is set for solved days."""
+        if not len(self):
+            return 0, bytearray()
+        first = self.day[0]
+        solved = bytearray(self.day[-1] - first + 1)
+        for day, secs in zip(self.day, self.solve_time_secs):
+            if secs > 0:
+                solved[day - first] = 1
+        return first, solved
+
+    def solve(self, day):
+        """(solve secs, cheated) if day was solved, else None."""
+        i = bisect_left(self.day, day)
+        if i < len(self) and self.day[i] == day and self.solve_time_secs[i] > 0:
+            return self.solve_time_secs[i], bool(self.cheated[i])
+        return None
+
+    def count_solved(self):
+        return sum(1 for secs in self.solve_time_secs if secs > 0)
+
+    def rows(self):
+        """Yields the records as csv-style row dicts, in date order."""
+        cell = lambda v: "" if v == MISSING else str(v)
+        columns = zip(
+            self.day,
+            self.puzzle_id,
+            self.solve_time_secs,
+            self.opened_unix,
+            self.solved_unix,
+            self.cheated,
+        )
+        for day, puzzle_id, secs, opened, solved, cheated in columns:
+            d = date.fromordinal(day)
+            yield {
+                "date": d.isoformat(),
+                "puzzle_id": cell(puzzle_id),
+                "weekday": d.strftime("%a"),
+                "solve_time_secs": cell(secs),
+                "opened_unix": cell(opened),
+                "solved_unix": cell(solved),
+                "cheated": str(bool(cheated)).lower(),
+            }
+
+    def numpy(self):
+        """Zero-copy NumPy views of the columns, for analysis. Needs numpy."""
+        import numpy as np
+
+        return {
+            name: np.frombuffer(getattr(self, name), dtype=typecode)
+            for name, typecode in Columns.TYPECODES.items()
+        }
+
+
+def parse(r):
+    """Parses a record as written to the csv file."""
     parsers = {
         "date": parse_date_string,
         "opened_unix": lambda s: datetime.fromtimestamp(int(s)) if s else None,
@@ -34,84 +230,120 @@ def read(filename):
     }
     I = lambda x: x
 
-    def parse(r):
-        return {k: parsers.get(k, I)(v) for k, v in r.items()}
+    return {k: parsers.get(k, I)(r.get(k, "")) for k in FIELDNAMES}
+
+
+def normalize(r):
+    """A row exactly as it reads back from the csv: all fields, as strings."""
+    return {k: "" if r.get(k) is None else str(r[k]) for k in FIELDNAMES}
 
+
+def read_rows(filename, quiet=False):
+    """Reads unparsed rows from a csv file, skipping a last line that a crash
+    mid-append left without its newline.
+    """
     try:
         with open(filename) as f:
-            reader = csv.DictReader(f)
-            return [parse(r) for r in reader]
+            lines = [line for line in f if line.endswith("\n")]
+            return [normalize(r) for r in csv.DictReader(lines)]
     except FileNotFoundError as e:
-        print(e)
+        if not quiet:
+            print(e)
         return []
 
 
-def missing_days(data, dates):
-    have_solve_data = {d["date"] for d in data if d["solve_time_secs"]}
-    return [d for d in dates if d not in have_solve_data]
+def read(filename):
+    """Reads records from csv file."""
+    return [parse(r) for r in read_rows(filename)]
 
 
-def prep_for_writing(data):
-    """Counterpart of read, formats data for writing, and preps for merging"""
-    formatters = {
-        "date": format_date,
-        "opened_unix": lambda dt: int(dt.timestamp()) if dt else "",
-        "solved_unix": lambda dt: int(dt.timestamp()) if dt else "",
-        "cheated": lambda b: str(b).lower(),
-        # 'solve_time_secs': str
-    }
-    I = lambda x: x
+def read_columns(filename, quiet=False):
+    """Reads a csv file straight into Columns, without building a dict or
+    datetime per row. Blank lines are skipped; a row with the wrong number of
+    cells raises ValueError, rather than shifting the columns out of step.
+    """
+    try:
+        with open(filename, newline="") as f:
+            reader = csv.reader(f)
+            header = next(reader, [])
+            rows = []
+            for row in reader:
+                if not row:
+                    continue
+                if len(row) != len(header):
+                    raise ValueError(
+                        "%s line %d: %d cells, not %d"
+                        % (filename, reader.line_num, len(row), len(header))
+                    )
+                rows.append(row)
+            return Columns.from_strings(dict(zip(header, zip(*rows))))
+    except FileNotFoundError as e:
+        if not quiet:
+            print(e)
+        return Columns()
 
-    def fmt(r):
-        return {k: formatters.get(k, I)(v) for k, v in r.items()}
 
-    formatted = [fmt(r) for r in data]
+def append_rows(filename, rows):
+    new = not drop_torn_line(filename)
+    with open(filename, "a") as f:
+        w = csv.DictWriter(f, FIELDNAMES)
+        if new:
+            w.writeheader()
+        w.writerows(rows)
 
-    return {r["date"]: r for r in formatted}
 
+def drop_torn_line(filename):
+    """Truncates a last line left without its newline by a crash mid-append,
+    so that appended rows don't run on from it. Returns the size left.
+    """
+    try:
+        with open(filename, "rb+") as f:
+            size = f.seek(0, os.SEEK_END)
+            if not size:
+                return 0
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.seek(0)
+                size = f.read().rfind(b"\n") + 1
+                f.truncate(size)
+            return size
+    except FileNotFoundError:
+        return 0
 
-def merge(r1, r2):
-    """Merges two sets of records and returns them sorted by date."""
-    merged = r1 | r2
-    return [v for (k, v) in sorted(merged.items(), key=lambda kv: kv[0])]
 
+def write_rows(filename, rows):
+    """Writes rows to filename in one go: readers see the old file or the new
+    one, never half of one.
+    """
+    with atomic_write(filename) as f:
+        w = csv.DictWriter(f, FIELDNAMES)
+        w.writeheader()
+        w.writerows(rows)
 
-def store(filename, data, stats):
-    old = prep_for_writing(data)
 
-    records = {}
-    for pi in stats:
-        date_str = pi["print_date"]
-        record = {
-            "date": date_str,
-            "puzzle_id": pi["puzzle_id"],
-            "weekday": parse_date_string(date_str).strftime("%a"),
-        }
-        solved = pi["calcs"].get("solved", False)
-        if solved:
-            cheated = any(c in pi["firsts"] for c in ["checked", "revealed"])
-            record.update(
-                {
-                    "solve_time_secs": pi["calcs"]["secondsSpentSolving"],
-                    "opened_unix": pi["firsts"]["opened"],
-                    "solved_unix": pi["firsts"]["solved"],
-                    "cheated": str(cheated).lower(),
-                }
-            )
-        else:
-            record.update(
-                {
-                    "cheated": "false",
-                }
-            )
-        records[date_str] = record
-
-    merged = merge(old, records)
-
-    # Write data in the format @kesyog uses.
-    h = "date,puzzle_id,weekday,solve_time_secs,opened_unix,solved_unix,cheated"
-    fieldnames = h.split(",")
-    with open(filename, "w") as f:
-        w = csv.DictWriter(f, fieldnames)
-        w.writeheader()
-        w.writerows(merged)
+def to_record(pi):
+    """Turns full stats (merged with puzzle info) into a csv row."""
+    date_str = pi["print_date"]
+    record = {
+        "date": date_str,
+        "puzzle_id": pi["puzzle_id"],
+        "weekday": parse_date_string(date_str).strftime("%a"),
+    }
+    solved = pi["calcs"].get("solved", False)
+    if solved:
+        cheated = any(c in pi["firsts"] for c in ["checked", "revealed"])
+        record.update(
+            {
+                "solve_time_secs": pi["calcs"]["secondsSpentSolving"],
+                "opened_unix": pi["firsts"]["opened"],
+                "solved_unix": pi["firsts"]["solved"],
+                "cheated": str(cheated).lower(),
+            }
+        )
+    else:
+        record.update(
+            {
+                "cheated": "false",
+            }
+        )
+    return record
@@ -0,0 +1,72 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util import make_headers
+
+from metrics import METRICS
+
+"""
+The requests sessions Api fetches with. Their connection pools hold as many
+sockets per host as there are threads to use them (requests' default is 10:
+any more threads and connections are opened and thrown away per request),
+and they ask for compressed responses in every encoding urllib3 can decode:
+gzip and deflate, plus br/zstd when brotli/zstandard are installed. Opened
+connections are counted as metrics, so reuse shows in the report.
+"""
+
+ACCEPT_ENCODING = make_headers(accept_encoding=True)["accept-encoding"]
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        METRICS.count("connections_opened")
+        return super()._new_conn()
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        METRICS.count("connections_opened")
+        return super()._new_conn()
+
+
+class PooledAdapter(HTTPAdapter):
+    """Keeps up to `connections` sockets open per host."""
+
+    def __init__(self, connections):
+        super().__init__(pool_maxsize=connections)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool,
+        }
+
+
+def session(cookies, connections):
+    """A session sending cookies, with a pool for `connections` threads."""
+    s = requests.Session()
+    adapter = PooledAdapter(connections)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    s.headers["Accept-Encoding"] = ACCEPT_ENCODING
+    for k, v in cookies.items():
+        s.cookies.set(k, v)
+    return s
+
+
+def summary():
+    """One line on connection reuse and compression, from METRICS."""
+    report = METRICS.report()
+    n = sum(e["requests"] for e in report["endpoints"].values())
+    if not n:
+        return "No requests made"
+    opened = report["counters"].get("connections_opened", 0)
+    size = sum(e["bytes"] for e in report["endpoints"].values())
+    wire = sum(e["wire_bytes"] for e in report["endpoints"].values())
+    return "%d requests on %d connections; %.1f MB on the wire for %.1f MB of json" % (
+        n,
+        opened,
+        wire / 1024 / 1024,
+        size / 1024 / 1024,
+    )
@@ -1,5 +1,8 @@
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from itertools import islice
+from itertools import chain, islice, zip_longest
+import os
+import threading
 
 
 def parse_date_string(s):
@@ -16,6 +19,24 @@ def date_range(start, end):
     return [start + timedelta(i) for i in range((end - start).days + 1)]
 
 
+@contextmanager
+def atomic_write(filename, mode="w"):
+    """Opens a temporary file beside filename to write, and moves it into
+    place once the with block is done: readers see the old file or the new
+    one, never half of one. If the block raises, the old file is left be.
+    """
+    # One per thread, in case several write the same file at once.
+    tmp = "%s.%d.tmp" % (filename, threading.get_ident())
+    try:
+        with open(tmp, mode) as f:
+            yield f
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
 def chunker(it, size):
     """via https://stackoverflow.com/a/61435714/2683"""
     iterator = iter(it)
@@ -23,6 +44,24 @@ def chunker(it, size):
         yield chunk
 
 
+def catch_up(index, store, puzzle_type, batch=500):
+    """Adds to index (a ClueIndex or GridStore) whatever puzzles store (a
+    puzzle DataDir, PackDir or SqliteStore) has that it doesn't: all of them
+    the first time round. Returns how many.
+    """
+    have = index.dates(puzzle_type)
+    todo = [d for d in store.dates() if d not in have]
+    for dates in chunker(todo, batch):
+        index.add(puzzle_type, [store.load(d) for d in dates])
+    return len(todo)
+
+
+def interleave(*lists):
+    """Round-robins through lists: interleave([1, 2, 3], [4]) is [1, 4, 2, 3]"""
+    skip = object()
+    return [x for x in chain(*zip_longest(*lists, fillvalue=skip)) if x is not skip]
+
+
 def split_into_continuous_chunks(dates):
     chunks = []
     if dates:
@@ -57,3 +96,17 @@ def chunk_dates(dates, size):
             for chunk in chunker(dr, size):
                 chunks.append((chunk[0], chunk[-1]))
     return chunks
+
+
+def plan_chunks(dates, size):
+    """Covers sorted dates with as few ranges of at most `size` days as
+    possible. Unlike chunk_dates, a range may span gaps (dates not asked
+    for), so callers must filter what comes back.
+    """
+    chunks = []
+    for d in dates:
+        if chunks and (d - chunks[-1][0]).days < size:
+            chunks[-1] = (chunks[-1][0], d)
+        else:
+            chunks.append((d, d))
+    return chunks
@@ -0,0 +1,99 @@
+import json
+import os
+from bisect import bisect_left, bisect_right
+from datetime import timedelta
+
+from utils import atomic_write, date_range, format_date, parse_date_string
+
+
+class Watermarks:
+    """What a DB was last found to have, per (kind, puzzle type): the range of
+    dates checked, and the dates in it that were missing at the time, as
+    intervals. Data only ever gets added, so everything else in the range is
+    still there; the next check need only look at the gaps, and at dates
+    outside the range. Stored as
+        {"kind type": {"begin": date, "end": date, "gaps": [[first, last], ...]}}
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            with open(filename) as f:
+                self.marks = json.load(f)
+        except FileNotFoundError:
+            self.marks = {}
+
+    def candidates(self, key, dates):
+        """The dates (a contiguous, sorted range) that might be missing."""
+        mark = self.marks.get(key)
+        if not mark or not dates:
+            return dates
+        begin, end = parse_date_string(mark["begin"]), parse_date_string(mark["end"])
+        lo, hi = bisect_left(dates, begin), bisect_right(dates, end)
+        gaps = [d for d in expand(mark["gaps"]) if dates[0] <= d <= dates[-1]]
+        return dates[:lo] + gaps + dates[hi:]
+
+    def update(self, key, dates, missing):
+        """Notes that of dates (as passed to candidates), missing were."""
+        if not dates:
+            return
+        gaps = set(missing)
+        begin, end = dates[0], dates[-1]
+        mark = self.marks.get(key)
+        if mark:
+            checked = set(self.candidates(key, dates))
+            gaps.update(d for d in expand(mark["gaps"]) if d not in checked)
+            old_begin = parse_date_string(mark["begin"])
+            old_end = parse_date_string(mark["end"])
+            # Days between two ranges that don't touch haven't been checked.
+            gaps.update(date_range(old_end + timedelta(1), begin - timedelta(1)))
+            gaps.update(date_range(end + timedelta(1), old_begin - timedelta(1)))
+            begin, end = min(begin, old_begin), max(end, old_end)
+
+        self.marks[key] = {
+            "begin": format_date(begin),
+            "end": format_date(end),
+            "gaps": [
+                [format_date(a), format_date(b)] for a, b in intervals(sorted(gaps))
+            ],
+        }
+
+    def forget(self, key, dates):
+        """Marks dates as missing again (eg after bad documents were removed)."""
+        mark = self.marks.get(key)
+        if not mark:
+            return
+        begin, end = parse_date_string(mark["begin"]), parse_date_string(mark["end"])
+        gaps = set(expand(mark["gaps"]))
+        gaps.update(d for d in dates if begin <= d <= end)
+        mark["gaps"] = [
+            [format_date(a), format_date(b)] for a, b in intervals(sorted(gaps))
+        ]
+
+    def clear(self):
+        self.marks = {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with atomic_write(self.filename) as f:
+            json.dump(self.marks, f, indent=4, sort_keys=True)
+
+
+def intervals(dates):
+    """Sorted dates as [(first, last), ...] runs of consecutive days."""
+    runs = []
+    for d in dates:
+        if runs and d - runs[-1][1] == timedelta(1):
+            runs[-1][1] = d
+        else:
+            runs.append([d, d])
+    return [tuple(r) for r in runs]
+
+
+def expand(gaps):
+    """The dates in [[first, last], ...] intervals of YYYY-MM-DD strings."""
+    for first, last in gaps:
+        d, last = parse_date_string(first), parse_date_string(last)
+        while d <= last:
+            yield d
+            d += timedelta(1)